@@ -10,6 +10,16 @@ from dataclasses import dataclass
 import json
 import asyncio
 from logger import logger
+import metrics
+import member_dump
+from time import perf_counter
+
+
+def _request_time(endpoint: str) -> metrics.Histogram:
+    return metrics.registry.histogram("api_request_seconds", "Duration of requests to the backend", endpoint=endpoint)
+
+
+_member_dump_parse_time = metrics.registry.histogram("member_dump_parse_seconds", "CPU time spent parsing the member dump")
 
 
 class APIError(Exception):
@@ -32,7 +42,13 @@ class APIError(Exception):
 class RemoteUserData:
     user_id: int
     name: str
-    encoding: list[float]
+    encoding: numpy.ndarray | list[float]
+
+
+@dataclass
+class UserDump:
+    users: list[RemoteUserData]
+    cursor: str | None    # position in the change log the dump was taken at; None if the backend doesn't send one
 
 
 class RemoteChange:
@@ -54,73 +70,195 @@ class RemoteChange:
             self.parsing_error = ex
 
 
-async def request_users(url: str) -> list[RemoteUserData]:
-    async with aiohttp.ClientSession() as aio_session:
-        async with aio_session.get(url) as response:
+@dataclass
+class UpdateBatch:
+    changes: list[RemoteChange]
+    cursor: str | None    # position to request the next changes from
+    etag: str | None
+    not_modified: bool = False    # the backend answered 304, nothing changed since `etag`
+    reset: bool = False    # the backend doesn't know the cursor any more, the full list must be loaded again
+
+
+class APIClient:
+    """
+    All requests to the backend go through one long-lived session, so the connections are pooled and kept alive
+    instead of paying DNS, TCP and TLS setup for every request. The session is created on first use in the running loop.
+    """
+
+    DEFAULT_TIMEOUT = {"total": 60, "connect": 10, "sock_read": 30}
+    CHUNK_SIZE = 64 * 1024
+
+    timeout: aiohttp.ClientTimeout
+    limit: int
+    keepalive_timeout: float
+
+    _session: aiohttp.ClientSession | None
+
+    def __init__(self, timeout: dict = None, limit: int = 4, keepalive_timeout: float = 60):
+        """
+        :param timeout: seconds by `aiohttp.ClientTimeout` field: "total", "connect", "sock_connect", "sock_read"
+        :param limit: maximum number of simultaneous connections
+        :param keepalive_timeout: seconds to keep an idle connection open
+        """
+        self.timeout = aiohttp.ClientTimeout(**(timeout if timeout is not None else self.DEFAULT_TIMEOUT))
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def _unbounded_timeout(self, extra_read: float = 0) -> aiohttp.ClientTimeout:
+        """
+        Timeout without the total limit, for responses that take long as a whole but keep flowing:
+        the member dump and the long polls. Only a stalled connection times out.
+        """
+        sock_read = self.timeout.sock_read or self.timeout.total
+        return aiohttp.ClientTimeout(total=None, connect=self.timeout.connect, sock_connect=self.timeout.sock_connect,
+                                     sock_read=sock_read + extra_read if sock_read else None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request_users(self, url: str) -> list[RemoteUserData]:
+        return (await self.request_user_dump(url)).users
+
+    async def request_user_dump(self, url: str) -> UserDump:
+        with _request_time("users").time():
+            return await self._request_user_dump(url)
+
+    async def _request_user_dump(self, url: str) -> UserDump:
+        started = perf_counter()
+        # a dump of tens of thousands of members may download for minutes on a slow link
+        async with self.session.get(url, timeout=self._unbounded_timeout()) as response:
             if response.status != 200:
                 raise await APIError.from_response("Failed status code", response)
-            data = dict(await response.json())
-            result = data.get("result", None)
 
-            if result is None:
-                raise await APIError.from_response("Invalid response", response)
+            # the dump is parsed while it is downloaded, the encodings go straight into one float32 array
+            parser = member_dump.MemberDumpParser(response.content_length)
+            try:
+                async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                    parser.feed(chunk)
+                data = parser.close()
+            except ValueError as ex:
+                raise APIError(f"Invalid response: {ex}", response.status, "") from ex
 
-            result = []
-            clients = json.loads(data.get("clients", "[]"))
+            if data.get("result", None) is None:
+                raise APIError("Invalid response", response.status, json.dumps(data))
 
-            for client in clients:
-                try:
-                    remote_user = RemoteUserData(client["id"], client["fio"], json.loads(client["encoding"]))
-                    result.append(remote_user)
-                except KeyError as ex:
-                    logger.error("Failed to parse client data", exc_info=ex)
-                    continue
+        _member_dump_parse_time.observe(parser.parse_time)
+        logger.info(f"Parsed {parser.count} clients from {parser.bytes_parsed / 1024 / 1024:.1f} MB in {parser.parse_time:.2f} s "
+                    f"({perf_counter() - started:.2f} s with the download)")
+        users = [RemoteUserData(user_id, name, parser.encodings[row]) for row, (user_id, name) in enumerate(zip(parser.ids, parser.names))]
+        return UserDump(users, _format_cursor(data.get("cursor")))
 
-            return result
+    async def request_updates(self, url: str) -> list[RemoteChange]:
+        return (await self.request_changes(url)).changes
 
+    async def request_changes(self, url: str, cursor: str = None, etag: str = None, wait: float = 0) -> UpdateBatch:
+        """
+        Requests the changes made after `cursor`. A backend without cursors ignores it and sends its usual updates.
+        :param etag: sent as If-None-Match; the backend may answer 304 without a body if nothing has changed
+        The backend answers 410 or {"reset": true} to a cursor it doesn't know, e.g. after its change log was reset.
+        :param wait: seconds the backend may hold the request until a change appears (long polling); 0 - answer at once
+        """
+        with _request_time("updates").time():
+            return await self._request_changes(url, cursor, etag, wait)
 
-async def request_updates(url: str) -> list[RemoteChange]:
-    async with aiohttp.ClientSession() as aio_session:
-        async with aio_session.get(url) as response:
+    async def _request_changes(self, url: str, cursor: str | None, etag: str | None, wait: float) -> UpdateBatch:
+        params = {}
+        if cursor is not None:
+            params["cursor"] = cursor
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        timeout = self.timeout
+        if wait > 0:
+            params["wait"] = str(int(wait))
+            # the response may not start for `wait` seconds
+            timeout = self._unbounded_timeout(wait)
+
+        async with self.session.get(url, params=params, headers=headers, timeout=timeout) as response:
+            if response.status == 304:
+                return UpdateBatch([], cursor, etag, not_modified=True)
+            if response.status == 410:
+                return UpdateBatch([], None, None, reset=True)
             if response.status != 200:
                 raise await APIError.from_response("Failed status code", response)
-            
+
             data = await response.json()
+            etag = response.headers.get("ETag", etag)
 
+            if data.get("reset", False):
+                return UpdateBatch([], None, None, reset=True)
             result = data.get("result", None)
             if result is None:
                 raise await APIError.from_response("Invalid response", response)
-            elif result == "error, no users found":
-                return []
 
+            cursor = _format_cursor(data.get("cursor", cursor))
             raw_changes = data.get("clients", None)
-            if raw_changes is None:
-                return []
-            return [RemoteChange(raw) for raw in json.loads(raw_changes)]
+            if result == "error, no users found" or raw_changes is None:
+                return UpdateBatch([], cursor, etag)
+            return UpdateBatch([RemoteChange(raw) for raw in json.loads(raw_changes)], cursor, etag)
 
+    async def send_opening(self, url: str, user_id: int, direction: bool, time: [datetime.datetime, None] = None):
+        """
+        :param direction: False - for entering; True - for exiting
+        :param time: Time of opening. Defaults to the current time.
+        """
 
-async def send_opening(url: str, user_id: int, direction: bool, time: [datetime.datetime, None] = None):
-    """
-    :param direction: False - for entering; True - for exiting
-    :param time: Time of opening. Defaults to the current time.
-    """
+        data = {
+            "type": "enter_event",
+            "id": str(user_id),
+            "date": (time or datetime.datetime.now()).strftime("%Y-%m-%d %H:%M"),
+            "type_event": str(direction+1)    # API backend expects '1' for entering event and '2' for exiting
+        }
 
-    data = {
-        "type": "enter_event",
-        "id": str(user_id),
-        "date": (time or datetime.datetime.now()).strftime("%Y-%m-%d %H:%M"),
-        "type_event": str(direction+1)    # API backend expects '1' for entering event and '2' for exiting
-    }
+        with _request_time("opening").time():
+            async with self.session.post(url, data=data) as response:
+                if response.status != 200:
+                    raise await APIError.from_response("Failed status code", response)
 
-    async with aiohttp.ClientSession() as aio_session:
-        async with aio_session.post(url, data=data) as response:
-            if response.status != 200:
-                raise await APIError.from_response("Failed status code", response)
+
+def _format_cursor(cursor: Any) -> str | None:
+    return str(cursor) if cursor is not None else None
+
+
+_default_client: APIClient | None = None
+
+
+def get_default_client() -> APIClient:
+    """The client used by the module level functions and by the objects created without a client."""
+    global _default_client
+    if _default_client is None:
+        _default_client = APIClient()
+    return _default_client
+
+
+async def request_users(url: str) -> list[RemoteUserData]:
+    return await get_default_client().request_users(url)
+
+
+async def request_updates(url: str) -> list[RemoteChange]:
+    return await get_default_client().request_updates(url)
+
+
+async def send_opening(url: str, user_id: int, direction: bool, time: [datetime.datetime, None] = None):
+    await get_default_client().send_opening(url, user_id, direction, time)
 
 
 async def debug_main():
     #await request_updates("http://127.0.0.1:8000")
-    await send_opening("https://fitnessneo.ru/add-event/", 5, True)
+    try:
+        await send_opening("https://fitnessneo.ru/add-event/", 5, True)
+    finally:
+        await get_default_client().close()
 
 if __name__ == "__main__":
     asyncio.run(debug_main())
@@ -0,0 +1,92 @@
+"""
+Recall/latency benchmark of the matching indexes against the exact scan on synthetic encodings.
+
+Run from the repository root:
+    python -m benchmarks.matching_index --sizes 1000 50000 --lists 64 256 --probes 4 8 16 --quantized
+
+Prints one JSON object per (size, parameters) combination.
+"""
+import argparse
+import json
+import time
+import numpy
+
+from encoding_matrix import EncodingMatrix
+import matching_index
+
+# dlib encodings of different people are usually 0.6-1.0 apart, photos of the same person 0.2-0.4
+PERSON_SIGMA = 0.055
+QUERY_NOISE = 0.3 / numpy.sqrt(EncodingMatrix.ENCODING_SIZE)
+GROUPS = 64
+
+
+def synthetic_encodings(count: int, rng: numpy.random.Generator) -> numpy.ndarray:
+    # a mixture of gaussians resembles the clustered structure of real face encodings better than a single one
+    centers = rng.normal(0, PERSON_SIGMA, (GROUPS, EncodingMatrix.ENCODING_SIZE))
+    groups = rng.integers(0, GROUPS, count)
+    return (centers[groups] + rng.normal(0, PERSON_SIGMA / 2, (count, EncodingMatrix.ENCODING_SIZE))).astype(numpy.float32)
+
+
+def percentile_ms(samples: list, q: float) -> float:
+    return float(numpy.percentile(samples, q) * 1000)
+
+
+def run(size: int, kind: str, params: dict, queries: int, seed: int) -> dict:
+    rng = numpy.random.default_rng(seed)
+    encodings = synthetic_encodings(size, rng)
+
+    matrix = EncodingMatrix()
+    index = matching_index.create_index(matrix, kind, **params)
+    started = time.perf_counter()
+    for i, encoding in enumerate(encodings):
+        index.add(matrix.add(i, encoding))
+    build_seconds = time.perf_counter() - started
+
+    targets = rng.integers(0, size, queries)
+    probes = encodings[targets] + rng.normal(0, QUERY_NOISE, (queries, EncodingMatrix.ENCODING_SIZE)).astype(numpy.float32)
+
+    hits = 0
+    latencies = []
+    for target, probe in zip(targets, probes):
+        exact = matrix.match(probe)
+        started = time.perf_counter()
+        result = index.search(probe)
+        latencies.append(time.perf_counter() - started)
+        if result is not None and result.slot == exact.slot:
+            hits += 1
+
+    return {
+        "size": size,
+        "index": kind,
+        "params": params,
+        "queries": queries,
+        "recall_at_1": hits / queries,
+        "build_seconds": build_seconds,
+        "p50_ms": percentile_ms(latencies, 50),
+        "p95_ms": percentile_ms(latencies, 95),
+        "mean_ms": float(numpy.mean(latencies) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--lists", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--probes", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--rerank", type=int, default=64)
+    parser.add_argument("--quantized", action="store_true", help="also benchmark IVF with quantized codes")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(json.dumps(run(size, "exact", {}, args.queries, args.seed)), flush=True)
+        for lists in args.lists:
+            for probes in args.probes:
+                for quantized in ((False, True) if args.quantized else (False, )):
+                    params = {"lists": lists, "probes": probes, "quantized": quantized, "rerank": args.rerank}
+                    print(json.dumps(run(size, "ivf", params, args.queries, args.seed)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Offline benchmark of the recognition pipeline stages.
+
+Run from the repository root:
+    python -m benchmarks.pipeline --output bench.json
+
+Stages: Recognizer.find_face, Recognizer.get_face_encoding per jitter count and model,
+Recognizer.get_matching_encoding_index and EncodingMatrix.match against synthetic databases,
+and Display.show_camera_image. Images are read from --images (benchmarks/images by default, see the README
+there); the image stages refuse to run without them. --synthetic runs them on random frames with a fixed
+face box instead, which only measures the raw cost of the calls, not a real load.
+Results are written as one JSON document so the files of two releases can be compared.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy
+import cv2
+
+from benchmarks.matching_index import synthetic_encodings
+from encoding_matrix import EncodingMatrix
+
+DEFAULT_IMAGES_PATH = os.path.join("benchmarks", "images")
+SYNTHETIC_FRAME_SIZE = (480, 800)
+SYNTHETIC_FACE = (140, 480, 340, 320)    # (top, right, bottom, left)
+
+
+def measure(func, repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    samples = numpy.array(samples) * 1000
+    return {
+        "runs": repeat,
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(numpy.percentile(samples, 50)),
+        "p95_ms": float(numpy.percentile(samples, 95)),
+        "min_ms": float(samples.min()),
+    }
+
+
+def load_images(path: str) -> list:
+    files = sorted(glob.glob(os.path.join(path, "*.png")) + glob.glob(os.path.join(path, "*.jpg")))
+    images = [(os.path.basename(f), cv2.imread(f)) for f in files]
+    return [(name, image) for name, image in images if image is not None]
+
+
+def synthetic_images(count: int) -> list:
+    rng = numpy.random.default_rng(0)
+    return [(f"synthetic-{i}", rng.integers(0, 256, SYNTHETIC_FRAME_SIZE + (3, ), dtype=numpy.uint8)) for i in range(count)]
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def bench_detection(recognizer, images: list, repeat: int) -> list:
+    results = []
+    for name, image in images:
+        face = recognizer.find_face(image)
+        results.append({"stage": "find_face", "image": name, "shape": list(image.shape), "face_found": face is not None,
+                        **measure(lambda: recognizer.find_face(image), repeat)})
+    return results
+
+
+def bench_encoding(recognizer, images: list, jitters: list, models: list, repeat: int, synthetic: bool = False) -> list:
+    results = []
+    for name, image in images:
+        face = SYNTHETIC_FACE if synthetic else recognizer.find_face(image)
+        if face is None:
+            print(f"No face found in '{name}', skipping its encoding", file=sys.stderr)
+            continue
+        for model in models:
+            for num_jitters in jitters:
+                results.append({"stage": "get_face_encoding", "image": name, "model": model, "num_jitters": num_jitters,
+                                **measure(lambda: recognizer.get_face_encoding(image, [face], num_jitters, model), repeat)})
+    return results
+
+
+def bench_matching(recognizer, sizes: list, repeat: int) -> list:
+    results = []
+    rng = numpy.random.default_rng(0)
+    for size in sizes:
+        encodings = synthetic_encodings(size, rng)
+        target = encodings[size // 2]
+        as_lists = [list(e) for e in encodings]
+        results.append({"stage": "get_matching_encoding_index", "size": size,
+                        **measure(lambda: recognizer.get_matching_encoding_index(target, as_lists), repeat)})
+
+        matrix = EncodingMatrix(size)
+        for i, encoding in enumerate(encodings):
+            matrix.add(i, encoding)
+        results.append({"stage": "EncodingMatrix.match", "size": size, **measure(lambda: matrix.match(target), repeat)})
+    return results
+
+
+def bench_display(images: list, repeat: int) -> list:
+    import display
+    try:
+        screen = display.Display()
+    except cv2.error as ex:
+        return [{"stage": "show_camera_image", "skipped": f"no display available: {ex}"}]
+
+    results = []
+    for name, image in images:
+        results.append({"stage": "show_camera_image", "image": name, "shape": list(image.shape),
+                        **measure(lambda: screen.show_camera_image(image), repeat)})
+    cv2.destroyAllWindows()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=DEFAULT_IMAGES_PATH)
+    parser.add_argument("--synthetic", action="store_true", help="run the image stages on random frames if there are no images")
+    parser.add_argument("--stages", nargs="+", default=["detection", "encoding", "matching", "display"],
+                        choices=["detection", "encoding", "matching", "display"])
+    parser.add_argument("--jitters", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--models", nargs="+", default=["small", "large"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="file to write the results to; stdout by default")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    synthetic = False
+    if not images and {"detection", "encoding", "display"} & set(args.stages):
+        if not args.synthetic:
+            parser.error(f"no *.png or *.jpg images in '{args.images}'; add face images (see benchmarks/images/README.md), "
+                         f"pass --images, or pass --synthetic to time the stages on random frames")
+        print(f"No images in '{args.images}', using synthetic frames", file=sys.stderr)
+        images = synthetic_images(3)
+        synthetic = True
+
+    results = []
+    if {"detection", "encoding", "matching"} & set(args.stages):
+        import face_detection
+        recognizer = face_detection.Recognizer()
+        if "detection" in args.stages:
+            results += bench_detection(recognizer, images, args.repeat)
+        if "encoding" in args.stages:
+            results += bench_encoding(recognizer, images, args.jitters, args.models, max(1, args.repeat // 4), synthetic)
+        if "matching" in args.stages:
+            results += bench_matching(recognizer, args.sizes, args.repeat)
+    if "display" in args.stages:
+        results += bench_display(images, args.repeat)
+
+    report = {
+        "revision": revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "opencv": cv2.__version__,
+        "images": "synthetic" if synthetic else (args.images if images else None),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Finds the connected cameras and their directions.
+
+Probing every /dev/video* node takes a while, so the result is kept in a camera map on disk
+and later boots only verify the mapped cameras instead of rescanning.
+
+Run from the repository root to print the map:
+    python -m camera_discovery [--rescan] [--map PATH]
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+import cv2
+from logger import logger
+
+debug = os.name != "posix"
+if debug:
+    from debug import debug_cfg as cfg
+else:
+    from rpi import rpi_cfg as cfg
+
+
+FALLBACK_INDEXES = range(10)    # probed where there are no /dev/video* nodes to enumerate
+
+
+@dataclass
+class CameraInfo:
+    index: int
+    direction: bool    # False - for entering; True - for exiting
+    width: int
+    height: int
+
+
+def list_video_nodes() -> list:
+    """
+    :return: indexes of the /dev/videoN nodes, sorted
+    """
+    indexes = []
+    for node in glob.glob("/dev/video*"):
+        match = re.fullmatch(r"/dev/video(\d+)", node)
+        if match:
+            indexes.append(int(match.group(1)))
+    return sorted(indexes)
+
+
+def open_camera(index: int) -> cv2.VideoCapture | None:
+    """
+    :return: the opened camera or None; a handle that failed to open is released
+    """
+    source = cv2.VideoCapture(index, cv2.CAP_V4L2) if not debug else cv2.VideoCapture(index)
+    if not source.isOpened():
+        source.release()
+        return None
+    return source
+
+
+def describe(index: int, source: cv2.VideoCapture) -> CameraInfo:
+    return CameraInfo(index, source.get(cv2.CAP_PROP_BACKLIGHT) == -1,
+                      int(source.get(cv2.CAP_PROP_FRAME_WIDTH)), int(source.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+
+def _open_all(indexes: list) -> dict:
+    """Opens the cameras in parallel; the OpenCV calls release the GIL, so the probes overlap."""
+    if not indexes:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(indexes)) as executor:
+        sources = executor.map(open_camera, indexes)
+    return {index: source for index, source in zip(indexes, sources) if source is not None}
+
+
+def _release_all(sources: dict):
+    for source in sources.values():
+        source.release()
+
+
+def load_map(path: str) -> dict | None:
+    """
+    :return: {"nodes": [...], "cameras": [CameraInfo]} or None if there is no valid map
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {"nodes": list(data["nodes"]), "cameras": [CameraInfo(**camera) for camera in data["cameras"]]}
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning(f"Ignoring the invalid camera map '{path}'", exc_info=ex)
+        return None
+
+
+def save_map(path: str, nodes: list, cameras: list):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"nodes": nodes, "cameras": [asdict(camera) for camera in cameras]}, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def scan(nodes: list) -> tuple:
+    """
+    Probes all nodes.
+    :return: (cameras, {index: opened source})
+    """
+    sources = _open_all(nodes or list(FALLBACK_INDEXES))
+    cameras = [describe(index, source) for index, source in sorted(sources.items())]
+    return cameras, sources
+
+
+def _verify(camera_map: dict, nodes: list) -> dict | None:
+    """
+    Opens the mapped cameras.
+    :return: {index: opened source} or None if the cameras don't match the map
+    """
+    # an empty map is always rescanned, the cameras may have been unplugged during the last boot only
+    if camera_map["nodes"] != nodes or not camera_map["cameras"]:
+        return None
+
+    cameras = camera_map["cameras"]
+    sources = _open_all([camera.index for camera in cameras])
+    if len(sources) == len(cameras) and all(describe(c.index, sources[c.index]).direction == c.direction for c in cameras):
+        return sources
+
+    _release_all(sources)
+    return None
+
+
+def open_cameras(map_path: str, rescan: bool = False) -> dict:
+    """
+    Opens the cameras listed in the camera map, or scans all nodes and rewrites the map
+    if there is no map, the nodes have changed or a mapped camera is missing or has another direction.
+    :return: {index: opened cv2.VideoCapture}
+    """
+    started = time.perf_counter()
+    nodes = list_video_nodes()
+
+    camera_map = None if rescan else load_map(map_path)
+    if camera_map is not None:
+        sources = _verify(camera_map, nodes)
+        if sources is not None:
+            logger.info(f"Opened {len(sources)} cameras from the camera map in {(time.perf_counter() - started) * 1000:.0f} ms")
+            return sources
+        logger.info("The cameras don't match the camera map, rescanning")
+
+    cameras, sources = scan(nodes)
+    try:
+        save_map(map_path, nodes, cameras)
+    except OSError as ex:
+        logger.warning(f"Failed to save the camera map to '{map_path}'", exc_info=ex)
+    found = ", ".join(f"{c.index} ({'exit' if c.direction else 'entrance'})" for c in cameras) or "no cameras"
+    logger.info(f"Scanned {len(nodes) or len(FALLBACK_INDEXES)} camera nodes in {(time.perf_counter() - started) * 1000:.0f} ms: {found}")
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the camera map, scanning the cameras if needed")
+    parser.add_argument("--map", default=cfg.CAMERA_MAP_PATH, help="camera map file")
+    parser.add_argument("--rescan", action="store_true", help="ignore the saved map")
+    args = parser.parse_args()
+
+    sources = open_cameras(args.map, args.rescan)
+    cameras = [describe(index, source) for index, source in sorted(sources.items())]
+    _release_all(sources)
+    print(json.dumps([asdict(camera) for camera in cameras], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,21 @@ import face_detection
 import asyncio
 import os
 import users
+import api
+import opening_queue as opening_queue_module
+import encoding_service
 from logger import logger
+import logger as logger_module
 import datetime
 import time
-import display
+import threading
+import display as display_module
+import face_tracking
+import identity_cache as identity_cache_module
+import metrics
+import frame_buffer
+import detector_scheduler
+import camera_discovery
 
 debug = os.name != "posix"
 debug_captures = (0,)
@@ -25,32 +36,57 @@ else:
     from rpi import rpi_cfg as cfg
 
 
+# created by the startup stages of main()
+encoder: encoding_service.EncodingService = None
+api_client: api.APIClient = None
+opening_queue: opening_queue_module.OpeningEventQueue = None
+captures: list = []
+display: display_module.Display = None
+recognizer: face_detection.Recognizer = None
+user_manager: users.UserManager = None
+identity_cache: identity_cache_module.IdentityCache = None
+
+# wakes the detector when a camera publishes a frame
+frame_scheduler = detector_scheduler.FrameScheduler(cfg.MAX_FRAME_AGE)
+first_frame = asyncio.Event()
+
 # setup cameras
 
 class Capture:
-    current_frame: [numpy.ndarray, None]
+    frames: frame_buffer.FrameRing
     index: int
     direction: bool    # False - for entering; True - for exiting
     delay: float
     flip_y: bool
     flip_x: bool
+    tracker: face_tracking.FaceTracker
+    waiting_track_id: [int, None]
 
     _source: cv2.VideoCapture
     _task: asyncio.Task
     _is_running: bool
-    _is_updated: bool
+    _taken_sequence: int    # sequence number of the last frame taken by get_if_updated
+    _raw: [numpy.ndarray, None]    # read buffer of flipped cameras; the flip writes into the ring
+    _flip_code: [int, None]
+    _reader: [threading.Thread, None]
+    _frame_notified: bool
     _delay_started: datetime.datetime
 
     CAPTURING_INTERVAL = .01
+    FRAME_RING_SIZE = 4
 
     def __init__(self, index, source):
         self.index = index
         self._source = source
-        self.current_frame = None
-        self._is_updated = False
+        self.frames = frame_buffer.FrameRing(self.FRAME_RING_SIZE)
+        self._taken_sequence = 0
+        self._raw = None
+        self._reader = None
+        self._frame_notified = False
         self.display_released = False
 
         source.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        self.configure_source({**cfg.CAMERA_DEFAULTS, **cfg.CAMERA_SETTINGS.get(index, {})})
 
         self.direction = self._source.get(cv2.CAP_PROP_BACKLIGHT) == -1
         if self.index < len(cfg.DELAYS):
@@ -58,67 +94,207 @@ class Capture:
         else:
             self.delay = 0
         self._delay_started = None
+        self.tracker = face_tracking.FaceTracker(cfg.TRACKER_REDETECT_INTERVAL, cfg.TRACKER_SEARCH_MARGIN)
+        self.waiting_track_id = None
+
+        self.frame_rate = metrics.FrameRateMeter(index)
+        self.read_time = metrics.registry.histogram("camera_read_seconds", "Time to read a frame from the camera", camera=index)
+        self.frame_interval = metrics.registry.histogram("camera_frame_interval_seconds", "Time between two frames of the camera", camera=index)
+        self.flip_time = metrics.registry.histogram("frame_flip_seconds", "Time to flip a frame", camera=index)
+        self.detection_time = metrics.registry.histogram("face_detection_seconds", "Time to detect a face on a frame", camera=index)
+        self.dropped_frames = metrics.registry.counter("camera_dropped_frames_total", "Frames replaced before the detector took them", camera=index)
+        self.read_failures = metrics.registry.counter("camera_read_failures_total", "Failed frame reads", camera=index)
 
         self.flip_y = self.direction in cfg.FLIP_Y
         self.flip_x = self.direction in cfg.FLIP_X
+        # a single cv2.flip call handles both axes
+        self._flip_code = -1 if self.flip_y and self.flip_x else 0 if self.flip_y else 1 if self.flip_x else None
+
+    @staticmethod
+    def _decode_fourcc(value: float) -> str:
+        code = int(value)
+        return "".join(chr((code >> 8 * i) & 0xFF) for i in range(4))
+
+    def configure_source(self, settings: dict):
+        """
+        Requests the format from the driver and logs what it actually accepted.
+        :param settings: "fourcc", "width", "height", "fps" and "buffer_size"; missing or None values are left as is
+        """
+        # V4L2 picks the resolutions available for the current pixel format, so FOURCC goes first
+        requested = []
+        if settings.get("fourcc"):
+            requested.append(("fourcc", cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*settings["fourcc"])))
+        for key, prop in (("width", cv2.CAP_PROP_FRAME_WIDTH), ("height", cv2.CAP_PROP_FRAME_HEIGHT),
+                          ("fps", cv2.CAP_PROP_FPS), ("buffer_size", cv2.CAP_PROP_BUFFERSIZE)):
+            if settings.get(key) is not None:
+                requested.append((key, prop, settings[key]))
+
+        for key, prop, value in requested:
+            if not self._source.set(prop, value):
+                logger.warning(f"Camera {self.index} rejected {key}={settings[key]}")
+
+        actual = {
+            "fourcc": self._decode_fourcc(self._source.get(cv2.CAP_PROP_FOURCC)),
+            "width": int(self._source.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(self._source.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps": self._source.get(cv2.CAP_PROP_FPS),
+            "buffer_size": int(self._source.get(cv2.CAP_PROP_BUFFERSIZE)),
+        }
+        for key, _, _ in requested:
+            accepted = actual[key] == settings[key] if key == "fourcc" else abs(actual[key] - settings[key]) < 0.5
+            if not accepted:
+                logger.warning(f"Camera {self.index} uses {key}={actual[key]} instead of requested {settings[key]}")
+
+        logger.info(f"Camera {self.index} format: {actual['fourcc']} {actual['width']}x{actual['height']} "
+                    f"@ {actual['fps']:.1f} fps, buffer size {actual['buffer_size']}")
+
+    def detection_zone(self, shape: tuple) -> tuple:
+        """
+        :return: (top, right, bottom, left) part of a frame with the given shape where faces are detected
+        """
+        h, w = shape[:2]
+        if self.direction:
+            return 0, min(w, cfg.DISPLAY_WIDTH), min(h, cfg.DISPLAY_HEIGHT), 0
+
+        # the zone of the entrance camera is the square outlined on the display
+        cx, cy = int(w / 2), int(h / 2)
+        half_rect_size = int(min(h, w) * cfg.DETECTION_ZONE_SIZE / 2)
+        return cy - half_rect_size, cx + half_rect_size, cy + half_rect_size, cx - half_rect_size
 
-    def get_if_updated(self, reset_status: bool = True) -> [numpy.ndarray, None]:
-        if self._is_updated:
-            if reset_status:
-                self._is_updated = False
-            return self.current_frame
-        return None
+    @property
+    def current_frame(self) -> [numpy.ndarray, None]:
+        latest = self.frames.latest
+        return latest.image if latest is not None else None
+
+    def get_if_updated(self, reset_status: bool = True) -> [frame_buffer.Frame, None]:
+        """
+        :return: the latest frame if it wasn't taken yet. The frame is pinned in the ring until it is released.
+        """
+        frame = self.frames.take(self._taken_sequence)
+        if frame is not None and reset_status:
+            self._taken_sequence = frame.sequence
+        return frame
+
+    def _read_into(self, buffer: [numpy.ndarray, None]) -> tuple:
+        # VideoCapture.read fills the given buffer in place if its shape and type match the frame
+        return self._source.read() if buffer is None else self._source.read(buffer)
 
     def start_capturing(self) -> asyncio.Task:
         self._is_running = True
-        self._task = asyncio.create_task(self.capturing_coroutine())
+        if cfg.CAPTURE_BACKEND == "thread":
+            self._task = asyncio.create_task(self.reader_thread_coroutine())
+        else:
+            self._task = asyncio.create_task(self.capturing_coroutine())
 
         return self._task
 
+    def _capture_frame(self) -> [frame_buffer.Frame, None]:
+        """
+        Reads, flips and publishes one frame. Blocks until the camera delivers it, so it is called off the event loop.
+        """
+        slot, buffer = self.frames.claim()
+        target = self._raw if self._flip_code is not None else buffer
+        with self.read_time.time():
+            ret, frame = self._read_into(target)
+        timestamp = time.monotonic()
+        if not ret:
+            self.read_failures.inc()
+            logger.error(f"Failed to read image from camera {self.index}: ret is False")
+            return None
+
+        self.frame_rate.tick()
+        if self._flip_code is not None:
+            self._raw = frame
+            if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+                buffer = numpy.empty_like(frame)
+            with self.flip_time.time():
+                frame = cv2.flip(frame, self._flip_code, dst=buffer)
+
+        previous = self.frames.latest
+        if previous is not None:
+            self.frame_interval.observe(timestamp - previous.timestamp)
+            if previous.sequence > self._taken_sequence:
+                self.dropped_frames.inc()
+        return self.frames.publish(slot, frame, timestamp)
+
+    def _on_frame(self):
+        """Event loop side handling of the latest frame."""
+        self._frame_notified = False
+        frame_scheduler.notify()
+        first_frame.set()
+        if self.direction:
+            return
+
+        # only the UI state is updated here, the display thread renders the frames of the entrance camera
+        if not self.display_released:
+            if self.is_waiting:
+                display.show_idle((datetime.datetime.now() - self._delay_started).total_seconds() / self.delay)
+            else:
+                display.show_idle(0)
+
     async def capturing_coroutine(self):
         logger.debug(f"Started capturing from camera {self.index}")
 
         while self._is_running:
             try:
-                ret, frame = await asyncio.get_event_loop().run_in_executor(None, self._source.read)
-                if ret:
-                    if self.flip_y:
-                        frame = cv2.flip(frame, 0)
-                    if self.flip_x:
-                        frame = cv2.flip(frame, 1)
-
-                    self.current_frame = frame
-
-                    if not self.direction:
-
-                        if not self.display_released:
-                            if self.is_waiting:
-                                display.show_idle((datetime.datetime.now() - self._delay_started).total_seconds() / self.delay)
-                            else:
-                                display.show_idle(0)
-
-                        display.show_camera_image(frame)
-
-                    self._is_updated = True
-                else:
-                    logger.error(f"Failed to read image from camera {self.index}: ret is False")
+                frame = await asyncio.get_event_loop().run_in_executor(None, self._capture_frame)
+                if frame is not None:
+                    self._on_frame()
             except Exception as ex:
+                self.read_failures.inc()
                 logger.error(f"Failed to read image from camera {self.index}", exc_info=ex)
 
             await asyncio.sleep(self.CAPTURING_INTERVAL)
 
         logger.debug(f"Stopped capturing from camera {self.index}")
 
+    def _reader_loop(self, loop: asyncio.AbstractEventLoop, stopped: asyncio.Future):
+        logger.debug(f"Started reader thread of camera {self.index}")
+        try:
+            while self._is_running:
+                try:
+                    frame = self._capture_frame()
+                except Exception as ex:
+                    self.read_failures.inc()
+                    logger.error(f"Failed to read image from camera {self.index}", exc_info=ex)
+                    frame = None
+
+                if frame is None:
+                    # don't spin on a failing camera
+                    time.sleep(self.CAPTURING_INTERVAL)
+                elif not self._frame_notified:
+                    # at most one pending notification; the loop always handles the latest frame
+                    self._frame_notified = True
+                    loop.call_soon_threadsafe(self._on_frame)
+        finally:
+            self._source.release()
+            logger.debug(f"Stopped reader thread of camera {self.index}")
+            try:
+                loop.call_soon_threadsafe(stopped.set_result, None)
+            except RuntimeError:
+                pass    # the loop is already closed
+
+    async def reader_thread_coroutine(self):
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        self._reader = threading.Thread(target=self._reader_loop, args=(loop, stopped), name=f"camera-{self.index}", daemon=True)
+        self._reader.start()
+        await stopped
+
     def stop_capturing(self):
         self._is_running = False
-        self._source.release()
+        if self._reader is None:
+            self._source.release()
+        # otherwise the reader thread releases the source after its current read
 
-    def start_waiting(self):
+    def start_waiting(self, track_id: int = None):
         if self.delay > 0:
             self._delay_started = datetime.datetime.now()
+            self.waiting_track_id = track_id
 
     def stop_waiting(self):
         self._delay_started = None
+        self.waiting_track_id = None
 
     @property
     def is_waiting(self) -> bool:
@@ -133,21 +309,8 @@ class Capture:
 
 
 def get_available_captures() -> list:
-    index = 0
-    arr = []
-    streak = 0
-    while True:
-        cap = cv2.VideoCapture(index)
-        if not cap.isOpened():
-            streak += 1
-            if streak > 5:
-                break
-        else:
-            capture = Capture(index, cap)
-            arr.append(capture)
-        
-        index += 1
-    return arr
+    sources = camera_discovery.open_cameras(cfg.CAMERA_MAP_PATH)
+    return [Capture(index, source) for index, source in sorted(sources.items())]
 
 
 def get_available_captures_debug() -> list:
@@ -159,133 +322,294 @@ def get_available_captures_debug() -> list:
     return arr
 
 
-captures = get_available_captures_debug() if debug else get_available_captures()
-logger.info(f"Found {len(captures)} captures")
+def open_captures() -> list:
+    found = get_available_captures_debug() if debug else get_available_captures()
+    logger.info(f"Found {len(found)} captures")
+    return found
 
-# setup display
-display = display.Display()
 
-# setup recognizer
-recognizer = face_detection.Recognizer()
+def create_user_manager() -> users.UserManager:
+    path = cfg.AUTHORIZED_FACES_PATH
+    logger.info(f"Faces directory: {os.path.join(os.getcwd(), path)}")
+    manager = users.UserManager(path, cfg.INIT_URL, cfg.UPDATE_URL, recognizer, encoder, cfg.REMOTE_SNAPSHOT_PATH, api_client, opening_queue)
+    manager.user_listeners.append(identity_cache.on_user_event)
+    return manager
 
-print(f"Path: {cfg.AUTHORIZED_FACES_PATH}")
 
-# setup faces user_manager
+encoding_time = metrics.registry.histogram("face_encoding_seconds", "Time to encode a batch of faces")
+matching_time = metrics.registry.histogram("face_matching_seconds", "Time to match a batch of encodings against the users")
+lock_time = metrics.registry.histogram("lock_actuation_seconds", "Time the lock controller takes to open and close the lock")
+startup_time = metrics.registry.gauge("startup_seconds", "Time from the start to the first frame and to the first possible unlock", stage="first_frame")
+ready_time = metrics.registry.gauge("startup_seconds", stage="ready")
 
-path = cfg.AUTHORIZED_FACES_PATH
-logger.info(f"Faces directory: {os.path.join(os.getcwd(), path)}")
-user_manager = users.UserManager(path, cfg.INIT_URL, cfg.UPDATE_URL, recognizer)
 
-logger.info("Initialization completed")
+def match_encodings(encodings: list) -> list:
+    with matching_time.time():
+        return user_manager.match_encodings(encodings)
 
-async def init_user_manager_remotes():
-    await asyncio.create_task(user_manager.load_remote_users())
-    user_manager.start_synchronization()
 
+async def init_user_manager_remotes(snapshot_age: [float, None]):
+    await user_manager.load_remote_users(snapshot_age)
+    user_manager.start_synchronization()
 
-async def detector_thread():
 
-    global captures
-    global user_manager
-    global recognizer
+async def identify(ready: list) -> list:
+    """
+    Identifies the faces of all captures that are ready for recognition as one batch.
+    :param ready: (capture, frame, track) tuples
+    :return: matched user, None or the identification exception per element of `ready`
+    """
+    results = [None] * len(ready)
+    pending = []
+    for i, (capture, frame, track) in enumerate(ready):
+        logger.info(f"Detected face on camera {capture.index}. Analizing...")
+        cached = identity_cache.get(capture.index, track.track_id)
+        if cached is not None:
+            results[i] = cached.user
+            logger.debug(f"Using cached identity of track {track.track_id}: {cached.user}")
+        else:
+            pending.append(i)
+
+    if not pending:
+        return results
+
+    try:
+        #p2 = time.time()
+        matches = await recognizer.identify_tiered(
+            len(pending),
+            lambda indexes, num_jitters: encoding_time.time_async(encoder.encode_batch(
+                [ready[pending[i]][1] for i in indexes], [ready[pending[i]][2].face for i in indexes], num_jitters
+            )),
+            match_encodings
+        )
+        #print("Second time:", time.time()- p2)
+    except Exception as ex:
+        matches = [ex] * len(pending)
+
+    for i, match in zip(pending, matches):
+        if isinstance(match, Exception):
+            results[i] = match
+            continue
+        capture, _, track = ready[i]
+        user = match.key if match is not None and recognizer.is_match(match.distance) else None
+        identity_cache.put(capture.index, track.track_id, user)
+        results[i] = user
+    return results
+
+
+async def handle_identification(capture: Capture, frame: numpy.ndarray, track: face_tracking.Track, user):
+    """
+    Opens the lock or denies access for the identification result of a capture.
+    :param user: matched user, None or the identification exception
+    """
+    face = track.face
+    show_denied = True
+    try:
+        if isinstance(user, Exception):
+            raise user
+
+        if user is None:
+            result = False
+        else:
+            logger.debug(f"Detected user: {user}")
+            if user.can_enter():
+                result = True
+                user.track_opening(capture.direction)
+                if cfg.SAVE_USER_IMAGE:
+                    p = os.path.join(cfg.SAVE_USER_IMAGE,
+                                     f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}_{user}.png")
+                    # the frame is a buffer of the capture's ring, draw on a copy
+                    img = cv2.rectangle(frame.copy(), (face[3], face[0]), (face[1], face[2]), (0, 255, 0), 2)
+                    cv2.imwrite(p, img)
+            else:
+                logger.debug("Access granted, but lock won't be opened because of row limit")
+                result = False
+                show_denied = False
+            user.track_opening_attempt()
+    except Exception as ex:
+        result = False
+        logger.error(f"Failed to identify faces from camera {capture.index}", exc_info=ex)
+
+    if result:
+        logger.info(f"Access granted")
+        capture.display_released = True
+        display.show_granted()
+        await lock_time.time_async(lock_controller.open_for_seconds(3))
+        display.show_idle()
+        capture.display_released = False
+    else:
+        logger.info(f"Access denied")
+        if show_denied:
+            capture.display_released = True
+            display.show_denied()
+            await asyncio.sleep(1)
+            display.show_idle()
+            capture.display_released = False
+
+    if result or show_denied:
+        # the detector didn't see the camera meanwhile, so the next face found near the box may be another person.
+        # Start a new track for it and identify it afresh instead of reusing this result
+        identity_cache.invalidate(capture.index, track.track_id)
+        capture.tracker.reset()
+    capture.stop_waiting()
 
-    asyncio.create_task(user_manager.load_local_users())
-    asyncio.create_task(init_user_manager_remotes())
 
-    if not captures:
-        logger.critical("No available cameras found. Exiting...")
-        exit()
+async def detector_thread():
 
     while True:
 
-        for capture in captures:
+        await frame_scheduler.wait()
 
-            frame = capture.get_if_updated()
-            if frame is None:
-                continue
+        # faces of all cameras that are ready for recognition on this tick
+        ready = []
 
-            lims = (0, cfg.DISPLAY_WIDTH, cfg.DISPLAY_HEIGHT, 0)
-            if not capture.direction:
-                cx, cy = int(frame.shape[1] / 2), int(frame.shape[0] / 2)
-                half_rect_size = int(min(frame.shape[0], frame.shape[1]) * cfg.DETECTION_ZONE_SIZE / 2)
-                lims = (cy - half_rect_size, cx + half_rect_size, cy + half_rect_size, cx - half_rect_size)
+        for capture in captures:
 
-                #frame = frame.copy()[100:480, 100:800]
+            taken = frame_scheduler.take(capture)
+            if taken is None:
+                continue
+            frame = taken.image
 
             #p1 = time.time()
-            face = recognizer.find_face(frame)
+            # detection runs only inside the zone, so every found face is within it
+            with capture.detection_time.time():
+                track = capture.tracker.update(frame, recognizer.find_face, capture.detection_zone(frame.shape))
             #print("First time:", time.time()- p1)
-            if face is None or face[0] < lims[0] or face[1] > lims[1] or face[2] > lims[2] or face[3] < lims[3]:
+            if track is None:
+                taken.release()
                 if capture.is_waiting:
                     capture.stop_waiting()
-            else:
-                #screen.recognizing()
-                if capture.delay > 0:
-                    if capture.is_waiting:
-                        if capture.is_delay_elapsed:
-                            capture.stop_waiting()
-                        else:
-                            continue
+                continue
+
+            #screen.recognizing()
+            if capture.delay > 0:
+                if capture.is_waiting and capture.waiting_track_id != track.track_id:
+                    # another person stepped in, the delay starts over
+                    capture.start_waiting(track.track_id)
+                    taken.release()
+                    continue
+                if capture.is_waiting:
+                    if capture.is_delay_elapsed:
+                        capture.stop_waiting()
                     else:
-                        capture.start_waiting()
+                        taken.release()
                         continue
+                else:
+                    capture.start_waiting(track.track_id)
+                    taken.release()
+                    continue
 
-                logger.info(f"Detected face on camera {capture.index}. Analizing...")
+            # the frame stays pinned in the ring until the identification is handled
+            ready.append((capture, taken, track))
 
-                show_denied = True
-                try:
-                    active_users = user_manager.get_all_active_users()
-                    #p2 = time.time()
-                    encoding = recognizer.get_face_encoding(frame, (face, ))
-                    #print("Second time:", time.time()- p2)
-                    matching_index = recognizer.get_matching_encoding_index(encoding, [u.encoding for u in active_users])
-
-                    if matching_index == -1:
-                        result = False
-                    else:
-                        user = active_users[matching_index]
-                        logger.debug(f"Detected user: {user}")
-                        if user.can_enter():
-                            result = True
-                            user.track_opening(capture.direction)
-                            if cfg.SAVE_USER_IMAGE:
-                                p = os.path.join(cfg.SAVE_USER_IMAGE,
-                                                 f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}_{user}.png")
-                                img = cv2.rectangle(frame, (face[3], face[0]), (face[1], face[2]), (0, 255, 0), 2)
-                                cv2.imwrite(p, img)
-                        else:
-                            logger.debug("Access granted, but lock won't be opened because of row limit")
-                            result = False
-                            show_denied = False
-                        user.track_opening_attempt()
-                except Exception as ex:
-                    result = False
-                    logger.error(f"Failed to identify faces from camera {capture.index}", exc_info=ex)
-
-                if result:
-                    logger.info(f"Access granted")
-                    capture.display_released = True
-                    display.show_granted()
-                    await lock_controller.open_for_seconds(3)
-                    display.show_idle()
-                    capture.display_released = False
-                else:
-                    logger.info(f"Access denied")
-                    if show_denied:
-                        capture.display_released = True
-                        display.show_denied()
-                        await asyncio.sleep(1)
-                        display.show_idle()
-                        capture.display_released = False
+        if ready:
+            results = await identify([(capture, taken.image, track) for capture, taken, track in ready])
+            # the cameras are handled concurrently, so the exit doesn't wait while the entrance lock is open
+            await asyncio.gather(*[handle_taken(capture, taken, track, user) for (capture, taken, track), user in zip(ready, results)])
 
-                capture.stop_waiting()
 
-        await asyncio.sleep(0.05)
+async def handle_taken(capture: Capture, taken, track, user):
+    with taken:
+        await handle_identification(capture, taken.image, track, user)
 
 
-async def main():
-    await asyncio.gather(detector_thread(), *[capture.start_capturing() for capture in captures])
+async def log_first_frame(started: float):
+    await first_frame.wait()
+    elapsed = time.perf_counter() - started
+    startup_time.set(elapsed)
+    logger.info(f"Time to first frame: {elapsed:.2f} s")
+
+
+async def load_in_background(started: float):
+    """
+    Startup stage 2, runs while the cameras are already shown.
+    The encoding workers load the models while the recognizer is created and the stored users are loaded.
+    The detector starts right after; the remote users are downloaded and the new local images are enrolled meanwhile.
+    """
+    global recognizer
+    global user_manager
+
+    recognizer = await asyncio.get_running_loop().run_in_executor(
+        None, face_detection.Recognizer, cfg.ENCODING_JITTER_TIERS, cfg.ENCODING_AMBIGUITY_BAND, cfg.DETECTION_DOWNSCALE)
+    user_manager = create_user_manager()
+
+    _, _, snapshot_age = await asyncio.gather(encoder.wait_ready(), user_manager.load_local_users(enroll=False),
+                                              user_manager.load_remote_snapshot())
+    asyncio.create_task(log_first_unlock(started))
+    asyncio.create_task(init_user_manager_remotes(snapshot_age))
+    asyncio.create_task(enroll_local_images())
 
 
+async def log_first_unlock(started: float):
+    # an unlock is possible once the models are loaded and there is someone to match
+    if not user_manager.local_users and not user_manager.remote_users:
+        await user_manager.remote_users_loaded_event.wait()
+    elapsed = time.perf_counter() - started
+    ready_time.set(elapsed)
+    logger.info(f"Time to first possible unlock: {elapsed:.2f} s "
+                f"({len(user_manager.local_users)} local users, {len(user_manager.remote_users)} remote users)")
 
-asyncio.run(main())
+
+async def enroll_local_images():
+    try:
+        await user_manager.enroll_local_images()
+    except Exception as ex:
+        logger.error("Failed to enroll the new local images", exc_info=ex)
+
+
+async def run_detector(started: float):
+    await load_in_background(started)
+    await detector_thread()
+
+
+async def main():
+    global encoder
+    global api_client
+    global opening_queue
+    global captures
+    global display
+    global identity_cache
+
+    started = time.perf_counter()
+    logger.debug(f"Logging to the '{logger_module.filename}'")
+
+    # stage 0: the pool forks the process, so it starts before any camera or display threads exist.
+    # The workers load the models in the background
+    encoder = encoding_service.EncodingService(cfg.ENCODING_WORKERS)
+    encoder.start()
+    api_client = api.APIClient(cfg.API_TIMEOUT, cfg.API_CONNECTION_LIMIT, cfg.API_KEEPALIVE_TIMEOUT)
+    opening_queue = opening_queue_module.OpeningEventQueue(cfg.OPENING_QUEUE_PATH, api_client, cfg.OPENING_EVENT_URL,
+                                                           cfg.OPENING_QUEUE_BATCH_SIZE, cfg.OPENING_QUEUE_MAX_RETRY_INTERVAL)
+
+    try:
+        # stage 1: cameras and display, the frames are shown as soon as they arrive
+        captures = open_captures()
+        if not captures:
+            logger.critical("No available cameras found. Exiting...")
+            return
+
+        display = display_module.Display(threaded=True)
+        entrance = next((capture for capture in captures if not capture.direction), None)
+        if entrance is not None:
+            display.set_source(entrance.frames)
+        display.start_rendering(cfg.DISPLAY_FPS)
+
+        identity_cache = identity_cache_module.IdentityCache(cfg.IDENTITY_CACHE_TTL, cfg.IDENTITY_CACHE_NEGATIVE_TTL)
+        opening_queue.start()
+        if cfg.METRICS_PORT:
+            await metrics.start_server(cfg.METRICS_HOST, cfg.METRICS_PORT)
+
+        asyncio.create_task(log_first_frame(started))
+
+        # stage 2: recognition comes up in the background
+        await asyncio.gather(run_detector(started), *[capture.start_capturing() for capture in captures])
+    finally:
+        if display is not None:
+            display.stop_rendering()
+        await opening_queue.stop()
+        await api_client.close()
+        encoder.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
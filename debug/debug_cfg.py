@@ -13,3 +13,32 @@ RECT_LINE_MIN = 13
 FLIP_Y = (1, )
 FLIP_X = (2, )
 DELAYS = (1, 0)
+MATCHING_INDEX = "exact"    # "exact" or "ivf"; see benchmarks/matching_index.py to pick IVF parameters
+MATCHING_INDEX_PARAMS = {"lists": 256, "probes": 8, "quantized": False, "rerank": 64}
+ENCODING_WORKERS = 0    # 0 - one worker process per CPU core
+ENCODING_JITTER_TIERS = (1, 5)    # a face is re-encoded with more jitters only if the match is ambiguous
+ENCODING_AMBIGUITY_BAND = 0.1    # ambiguous if |distance - 0.5| <= band
+TRACKER_REDETECT_INTERVAL = 10    # frames between full-frame face detections while a face is tracked
+TRACKER_SEARCH_MARGIN = .5    # search region around the tracked face, as a fraction of its size
+DETECTION_DOWNSCALE = 2    # frames are shrunk by this factor before Haar face detection
+IDENTITY_CACHE_TTL = 30    # seconds a recognized face keeps its identity while it is tracked
+IDENTITY_CACHE_NEGATIVE_TTL = 10    # the same for unknown faces
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9110    # Prometheus metrics at /metrics; 0 - disabled
+CAPTURE_BACKEND = "thread"    # "thread" - a reader thread per camera; "executor" - reads through the default executor
+CAMERA_DEFAULTS = {"fourcc": "MJPG", "width": 1280, "height": 720, "fps": 30, "buffer_size": 1}    # None - keep the driver's value
+CAMERA_SETTINGS = {}    # camera index -> settings overriding CAMERA_DEFAULTS
+MAX_FRAME_AGE = .5    # seconds; older frames are dropped by the detector. 0 - no limit
+DISPLAY_FPS = 30    # frame rate cap of the display render thread
+CAMERA_MAP_PATH = "cameras.json"    # camera index -> direction, written by camera_discovery
+REMOTE_SNAPSHOT_PATH = "remote"    # snapshot of the remote users, loaded at start before any request
+REMOTE_SNAPSHOT_MAX_AGE = 7 * 24 * 3600    # seconds; an older snapshot is replaced with a full download
+API_TIMEOUT = {"total": 120, "connect": 10, "sock_read": 30}    # seconds, see aiohttp.ClientTimeout; the member dump has no total limit
+API_CONNECTION_LIMIT = 4
+API_KEEPALIVE_TIMEOUT = 60    # seconds to keep an idle backend connection open
+OPENING_QUEUE_PATH = "openings.log"    # opening events waiting to be sent
+OPENING_QUEUE_BATCH_SIZE = 20
+OPENING_QUEUE_MAX_RETRY_INTERVAL = 300    # seconds
+SYNC_MIN_INTERVAL = 5    # seconds between polls for remote updates while they bring changes
+SYNC_MAX_INTERVAL = 120    # seconds; idle polls back off up to this interval
+SYNC_LONG_POLL = 0    # seconds the server may hold a poll until a change appears; 0 - no long polling
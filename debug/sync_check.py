@@ -0,0 +1,122 @@
+"""
+Checks the sync client against the reference server of the member sync protocol (debug/sync_server.py).
+
+Run from the repository root:
+    python -m debug.sync_check
+
+The server runs in this process on a free port. Checked: the cursor of the dump and of the updates, 304 on
+an unchanged ETag, long polls waiting for a change and timing out, the reset response to an unknown cursor,
+and a UserManager reloading the full list after a reset. Exits with an error on the first failed check.
+"""
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import api
+import users
+from debug import sync_server
+
+
+class QuietHandler(sync_server.HttpGetHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> tuple:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def post(base: str, path: str, data: dict = None):
+    request = urllib.request.Request(base + path, data=json.dumps(data or {}).encode(), method="POST")
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def add_change(user_id: int) -> dict:
+    return {"action": "add", "user_id": user_id, "fio": f"Test {user_id}", "encoding": [user_id / 1000] * 128}
+
+
+def check(condition: bool, text: str):
+    if not condition:
+        raise AssertionError(text)
+    print(f"ok   {text}")
+
+
+async def check_protocol(base: str, client: api.APIClient):
+    dump_url, updates_url = base + "/get-faceid-users/", base + "/get-new-faceid-users/"
+    post(base, "/changes", add_change(1))
+
+    dump = await client.request_user_dump(dump_url)
+    check(len(dump.users) == 1 and dump.cursor is not None, "the dump has the members and a cursor")
+
+    batch = await client.request_changes(updates_url, dump.cursor)
+    check(not batch.changes and batch.cursor == dump.cursor and batch.etag is not None, "no changes after the dump cursor")
+    batch = await client.request_changes(updates_url, batch.cursor, batch.etag)
+    check(batch.not_modified and batch.cursor == dump.cursor, "304 for an unchanged ETag")
+
+    post(base, "/changes", add_change(2))
+    post(base, "/changes", {"action": "delete", "user_id": 1})
+    batch = await client.request_changes(updates_url, batch.cursor, batch.etag)
+    check([(c.action, c.related_user_id) for c in batch.changes] == [("add", 2), ("delete", 1)] and batch.cursor != dump.cursor,
+          "the changes after the cursor, in order, and a new cursor")
+
+    timer = threading.Timer(.5, post, (base, "/changes", add_change(3)))
+    timer.start()
+    started = time.monotonic()
+    held = await client.request_changes(updates_url, batch.cursor, batch.etag, wait=5)
+    elapsed = time.monotonic() - started
+    check(.4 < elapsed < 3 and [c.related_user_id for c in held.changes] == [3], f"a long poll returns when a change appears ({elapsed:.2f} s)")
+
+    started = time.monotonic()
+    idle = await client.request_changes(updates_url, held.cursor, held.etag, wait=1)
+    elapsed = time.monotonic() - started
+    check(idle.not_modified and elapsed >= .9, f"an idle long poll answers 304 after the wait ({elapsed:.2f} s)")
+
+    post(base, "/reset")
+    batch = await client.request_changes(updates_url, held.cursor, held.etag)
+    check(batch.reset, "a cursor from before a reset of the log asks for a reset")
+    batch = await client.request_changes(updates_url, "not a cursor")
+    check(batch.reset, "a malformed cursor asks for a reset")
+
+
+async def check_user_manager(base: str, client: api.APIClient):
+    users.cfg.SYNC_MIN_INTERVAL, users.cfg.SYNC_MAX_INTERVAL, users.cfg.SYNC_LONG_POLL = .1, .2, 0
+    with tempfile.TemporaryDirectory() as directory:
+        manager = users.UserManager("", base + "/get-faceid-users/", base + "/get-new-faceid-users/",
+                                    snapshot_path=directory, api_client=client)
+        await manager.load_remote_users()
+        manager.start_synchronization()
+        expected = set(sync_server.log.members)
+        check({u.user_id for u in manager.remote_users} == expected, "the manager loads the dump")
+
+        post(base, "/changes", add_change(4))
+        await asyncio.sleep(1)
+        check({u.user_id for u in manager.remote_users} == expected | {4}, "the manager applies an update")
+
+        post(base, "/reset")
+        post(base, "/changes", add_change(5))
+        await asyncio.sleep(1)
+        check({u.user_id for u in manager.remote_users} == set(sync_server.log.members), "the manager reloads the list after a reset")
+        check(manager.sync_position.cursor == sync_server.log.cursor(sync_server.log.version), "the manager continues from the new cursor")
+
+
+async def main():
+    server, base = start_server()
+    client = api.APIClient()
+    try:
+        await check_protocol(base, client)
+        await check_user_manager(base, client)
+    finally:
+        await client.close()
+        server.shutdown()
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
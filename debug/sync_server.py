@@ -1,30 +1,169 @@
-from http.server import BaseHTTPRequestHandler
-from http.server import HTTPServer
+"""
+Reference implementation of the member sync protocol, for testing the synchronization locally.
+
+    GET /get-faceid-users/ - full dump: {"result": "ok", "clients": "[{id, fio, encoding}, ...]", "cursor": C}
+    GET /get-new-faceid-users/?cursor=C&wait=S - changes after cursor C:
+        {"result": "ok", "clients": "[{action, user_id, fio, encoding}, ...]", "cursor": C2}
+        The ETag is the current cursor. 304 if If-None-Match is the current cursor and there are no changes.
+        With `wait` the request is held up to S seconds until a change appears.
+        410 {"result": "reset", "reset": true} if the cursor is unknown, e.g. from before a reset of the log;
+        the client must load the full dump again.
+        Without `cursor` the changes since the previous request are sent, like the production backend does.
+    POST /changes - appends a change: {"action": "add" | "delete", "user_id": ..., "fio": ..., "encoding": [...]}
+    POST /reset - drops the change log, as a backend restored from a backup would; the members are kept
+
+A cursor is "<epoch>.<version>": version N is the state after the N-th change of the log, and the epoch
+changes on every reset, so a cursor from before a reset is never taken for a position in the new log.
+
+Run from the repository root:
+    python -m debug.sync_server [--port 8000] [--random-changes SECONDS]
+"""
+from __future__ import annotations
+
+import argparse
 import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+MAX_WAIT = 60
+
+
+class ChangeLog:
+    """Versioned log of the member changes; version N is the state after the N-th change."""
+
+    def __init__(self):
+        self.epoch = random.randint(1, 10 ** 6)
+        self.changes = []
+        self.members = {}    # user ID -> (fio, encoding)
+        self.last_sent = 0    # version sent to a client without a cursor
+        self.condition = threading.Condition()
+
+    @property
+    def version(self) -> int:
+        return len(self.changes)
+
+    def cursor(self, version: int) -> str:
+        return f"{self.epoch}.{version}"
+
+    def parse_cursor(self, cursor: str) -> int | None:
+        """
+        :return: the version of the cursor, None if the cursor doesn't belong to the current log
+        """
+        epoch, _, version = cursor.partition(".")
+        if epoch != str(self.epoch) or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def reset(self):
+        with self.condition:
+            self.epoch += 1
+            self.changes = []
+            self.last_sent = 0
+            self.condition.notify_all()
+
+    def append(self, change: dict):
+        with self.condition:
+            if change["action"] == "add":
+                self.members[change["user_id"]] = (change["fio"], change["encoding"])
+            elif change["action"] == "delete":
+                self.members.pop(change["user_id"], None)
+            else:
+                raise ValueError(f"Unknown action {change['action']}")
+            self.changes.append(change)
+            self.condition.notify_all()
 
-sentUpdated = False
-json_response = '''{"result":"ok", "clients":"[{\\"action\\": \\"delete\\", \\"user_id\\": 12, \\"encoding\\": [-0.06188490241765976], \\"fio\\": \\"2 1\\"}]"}'''
-json_response = json_response.replace(", ", ",").replace(": ", ":")
-clients = json.dumps([{"action": "delete", "user_id": 18, "encoding": [-0.06188490241765976], "fio": "2 1"}])
-data = {"result": "ok", "clients": clients}
-#print(json.dumps(data))
-print(json_response)
-#print(json.loads(json_response))
+
+log = ChangeLog()
+
+
+def random_change() -> dict:
+    if log.members and random.random() < .3:
+        return {"action": "delete", "user_id": random.choice(list(log.members))}
+    user_id = random.randint(1, 10 ** 6)
+    return {"action": "add", "user_id": user_id, "fio": f"Test {user_id}", "encoding": [random.uniform(-.3, .3) for _ in range(128)]}
 
 
 class HttpGetHandler(BaseHTTPRequestHandler):
     """Обработчик с реализованным методом do_GET."""
 
-    def do_GET(self):
-        global sentUpdated
-        self.send_response(200)
+    def send_json(self, data: dict, etag: str = None, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
         self.end_headers()
-        self.wfile.write(json_response.encode())
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.rstrip("/").endswith("get-faceid-users"):
+            with log.condition:
+                clients = [{"id": user_id, "fio": fio, "encoding": json.dumps(encoding)} for user_id, (fio, encoding) in log.members.items()]
+                cursor = log.cursor(log.version)
+            self.send_json({"result": "ok", "clients": json.dumps(clients), "cursor": cursor})
+            return
+
+        try:
+            wait = min(MAX_WAIT, max(0.0, float(query.get("wait", ["0"])[0])))
+        except ValueError:
+            wait = 0
+
+        with log.condition:
+            epoch = log.epoch
+            version = log.parse_cursor(query["cursor"][0]) if "cursor" in query else log.last_sent
+            if version is not None and wait > 0:
+                start = version
+                log.condition.wait_for(lambda: log.version > start or log.epoch != epoch, wait)
+            reset = version is None or log.epoch != epoch
+            if not reset:
+                changes = log.changes[version:]
+                cursor = log.cursor(log.version)
+                log.last_sent = log.version
+
+        if reset:
+            self.send_json({"result": "reset", "reset": True}, status=410)
+            return
+
+        etag = f'"{cursor}"'
+        if not changes and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        clients = [{"fio": "", "encoding": [], **change} for change in changes]
+        self.send_json({"result": "ok", "clients": json.dumps(clients), "cursor": cursor}, etag)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/").endswith("reset"):
+            log.reset()
+            self.send_json({"result": "ok", "cursor": log.cursor(log.version)})
+            return
+        try:
+            change = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            log.append(change)
+        except (ValueError, KeyError) as ex:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(str(ex).encode())
+            return
+        self.send_json({"result": "ok", "cursor": log.cursor(log.version)})
+
+
+def produce_changes(interval: float):
+    while True:
+        threading.Event().wait(random.expovariate(1 / interval))
+        log.append(random_change())
 
 
-def run(server_class=HTTPServer, handler_class=BaseHTTPRequestHandler):
-    server_address = ('', 8000)
+def run(server_class=ThreadingHTTPServer, handler_class=BaseHTTPRequestHandler, port: int = 8000):
+    server_address = ('', port)
     httpd = server_class(server_address, handler_class)
     try:
         httpd.serve_forever()
@@ -33,4 +172,10 @@ def run(server_class=HTTPServer, handler_class=BaseHTTPRequestHandler):
 
 
 if __name__ == "__main__":
-    run(handler_class=HttpGetHandler)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Reference server of the member sync protocol")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--random-changes", type=float, default=0, metavar="SECONDS", help="mean interval of random changes; 0 - none")
+    args = parser.parse_args()
+    if args.random_changes > 0:
+        threading.Thread(target=produce_changes, args=(args.random_changes, ), daemon=True).start()
+    run(handler_class=HttpGetHandler, port=args.port)
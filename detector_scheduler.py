@@ -0,0 +1,50 @@
+import asyncio
+import metrics
+import frame_buffer
+
+
+class FrameScheduler:
+    """
+    Wakes the detector as soon as any camera publishes a frame instead of polling the captures.
+
+    Captures call `notify` on the event loop for every new frame. The detector `wait`s and then `take`s the
+    newest frame of every capture; frames older than `max_age` seconds are dropped and counted.
+    """
+
+    max_age: float
+
+    _event: asyncio.Event
+    _stale: dict
+
+    def __init__(self, max_age: float):
+        """
+        :param max_age: seconds after which a frame is too old to be processed. 0 - no limit.
+        """
+        self.max_age = max_age
+        self._event = asyncio.Event()
+        self._stale = {}
+
+    def notify(self):
+        self._event.set()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+    def take(self, capture) -> frame_buffer.Frame:
+        """
+        :return: the newest untaken frame of the capture, or None if there is no such frame or it is stale
+        """
+        frame = capture.get_if_updated()
+        if frame is None:
+            return None
+
+        if self.max_age and frame.age > self.max_age:
+            frame.release()
+            counter = self._stale.get(capture.index)
+            if counter is None:
+                counter = self._stale[capture.index] = metrics.registry.counter(
+                    "detector_stale_frames_total", "Frames dropped by the detector because they were too old", camera=capture.index)
+            counter.inc()
+            return None
+        return frame
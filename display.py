@@ -3,6 +3,11 @@ import subprocess
 import os
 import numpy as np
 import math
+import threading
+import time
+import _thread
+import metrics
+from logger import logger
 
 debug = os.name != "posix"
 if debug:
@@ -17,20 +22,103 @@ class Display:
     GRANTED_RECT_COLOR = (0, 255, 0)
     DENIED_RECT_COLOR = (0, 0, 255)
 
-    def __init__(self):
-        cv2.namedWindow("Display", cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty("Display", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-        cv2.moveWindow("Display", 0, 0)
+    RECT_THICKNESS = 2
+    OVERLAY_STEPS = 50    # the filling progress is quantized to this many overlays
+    MAX_CACHED_OVERLAYS = 512
+
+    def __init__(self, threaded: bool = False):
+        """
+        :param threaded: the window is created and drawn only by the render thread, see `start_rendering`
+        """
+        self.threaded = threaded
+        if not threaded:
+            self._create_window()
 
         self.rect_color = self.DEFAULT_RECT_COLOR
         self.filling = 1
         self.current_frame = np.zeros((350, 500, 3), dtype=np.uint8)
+        self.render_time = metrics.registry.histogram("display_render_seconds", "Time to render a camera frame on the display")
+
+        self._overlays = {}
+        self._canvas = None
+        self._source = None
+        self._dirty = False
+        self._is_rendering = False
+        self._thread = None
+
+    @staticmethod
+    def _create_window():
+        cv2.namedWindow("Display", cv2.WINDOW_NORMAL)
+        cv2.setWindowProperty("Display", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        cv2.moveWindow("Display", 0, 0)
+
+    def set_source(self, frames):
+        """
+        :param frames: `frame_buffer.FrameRing` whose latest frame the render thread shows
+        """
+        self._source = frames
+
+    def start_rendering(self, fps: float):
+        """Starts the render thread. It shows the latest frame of the source at most `fps` times per second."""
+        self._is_rendering = True
+        self._thread = threading.Thread(target=self._render_loop, args=(fps, ), name="display", daemon=True)
+        self._thread.start()
+
+    def stop_rendering(self, timeout: float = 1):
+        """
+        Stops the render thread and waits for it to close the window.
+        :param timeout: seconds to wait for the thread, e.g. while it is stuck in a slow draw
+        """
+        self._is_rendering = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning(f"The display render thread didn't stop in {timeout} s")
+            self._thread = None
+
+    def _render_loop(self, fps: float):
+        self._create_window()
+        interval = 1 / fps if fps > 0 else 0
+        last_sequence = 0
+        while self._is_rendering:
+            started = time.perf_counter()
+            frame = self._source.take(last_sequence) if self._source is not None else None
+            if frame is not None:
+                # the frame is pinned in the camera's ring while it is rendered, no copy is needed
+                with frame:
+                    last_sequence = frame.sequence
+                    with self.render_time.time():
+                        self.show_camera_image(frame.image)
+            else:
+                if self._dirty:
+                    self._dirty = False
+                    self._refresh_ui()
+                self._poll_keys()
+
+            time.sleep(max(0.001, interval - (time.perf_counter() - started)))
+        # the window belongs to this thread, it is torn down here too
+        cv2.destroyWindow("Display")
+
+    def _poll_keys(self):
+        if cv2.waitKey(1) == ord('q'):
+            if self.threaded:
+                # exit() would only stop the render thread
+                _thread.interrupt_main()
+                self._is_rendering = False
+            else:
+                exit()
 
     def show_granted(self, refresh: bool = True):
         self.filling = 1
         self.rect_color = self.GRANTED_RECT_COLOR
 
         if refresh and self.current_frame is not None:
+            self._request_refresh()
+
+    def _request_refresh(self):
+        if self.threaded:
+            self._dirty = True
+        else:
             self._refresh_ui()
 
     def show_idle(self, progress: float = 0):
@@ -42,13 +130,13 @@ class Display:
         self.rect_color = self.DENIED_RECT_COLOR
 
         if refresh and self.current_frame is not None:
-            self._refresh_ui()
+            self._request_refresh()
 
     @staticmethod
     def overlay_image_alpha(img, img_overlay, x, y, alpha_mask):
         """Overlay `img_overlay` onto `img` at (x, y) and blend using `alpha_mask`.
 
-        `alpha_mask` must have same HxW as `img_overlay` and values in range [0, 1].
+        `alpha_mask` must have same HxW as `img_overlay` and values in range [0, 1], or uint8 values in range [0, 255].
         """
         # Image ranges
         y1, y2 = max(0, y), min(img.shape[0], y + img_overlay.shape[0])
@@ -62,13 +150,32 @@ class Display:
         if y1 >= y2 or x1 >= x2 or y1o >= y2o or x1o >= x2o:
             return
 
+        if alpha_mask.dtype != np.uint8:
+            alpha_mask = np.rint(alpha_mask * 255).astype(np.uint8)
+
         # Blend overlay within the determined ranges
-        img_crop = img[y1:y2, x1:x2]
-        img_overlay_crop = img_overlay[y1o:y2o, x1o:x2o]
-        alpha = alpha_mask[y1o:y2o, x1o:x2o, np.newaxis]
-        alpha_inv = 1.0 - alpha
+        premultiplied, alpha_inv = Display._premultiply(img_overlay[y1o:y2o, x1o:x2o], alpha_mask[y1o:y2o, x1o:x2o])
+        Display._blend(img[y1:y2, x1:x2], premultiplied, alpha_inv)
 
-        img_crop[:] = alpha * img_overlay_crop + alpha_inv * img_crop
+    @staticmethod
+    def _premultiply(overlay, alpha_mask) -> tuple:
+        """
+        :param alpha_mask: uint8, 255 - opaque
+        :return: (overlay * alpha + 128, 255 - alpha) as uint16, the constant part of `_blend`
+        """
+        alpha = alpha_mask.astype(np.uint16)[..., np.newaxis]
+        return overlay.astype(np.uint16) * alpha + 128, 255 - alpha
+
+    @staticmethod
+    def _blend(img, premultiplied, alpha_inv):
+        """In place (overlay * a + img * (255 - a)) / 255 in 16-bit fixed point, without float conversions."""
+        blended = img.astype(np.uint16)
+        blended *= alpha_inv
+        blended += premultiplied
+        # exact rounded division by 255 of values below 65535
+        blended += blended >> 8
+        blended >>= 8
+        img[:] = blended
 
     def _draw_dashed_line(self, frame, p0, p1, thickness, color, dashes, dash_length):
 
@@ -114,24 +221,64 @@ class Display:
 
         return frame
 
-    def _draw_ui(self, frame):
-        h, w = frame.shape[:2]
-
+    def _build_overlay(self, shape: tuple, color: tuple, filling: float) -> tuple:
+        """
+        Draws the dashed rectangle once.
+        :return: (flat indexes of the covered pixels, premultiplied overlay, inverted alpha), see `_premultiply`
+        """
+        h, w = shape
         rect_size = int(min(w, h) * cfg.DETECTION_ZONE_SIZE)
-        self._draw_dashed_rect(frame, (int(w / 2), int(h / 2)), rect_size, 2, self.rect_color, self.filling)
+        center = (int(w / 2), int(h / 2))
+
+        overlay = np.zeros((h, w, 3), dtype=np.uint8)
+        alpha = np.zeros((h, w), dtype=np.uint8)
+        self._draw_dashed_rect(overlay, center, rect_size, self.RECT_THICKNESS, color, filling)
+        self._draw_dashed_rect(alpha, center, rect_size, self.RECT_THICKNESS, 255, filling)
+
+        indexes = np.flatnonzero(alpha)
+        return (indexes, ) + self._premultiply(overlay.reshape(-1, 3)[indexes], alpha.reshape(-1)[indexes])
+
+    def _get_overlay(self, shape: tuple, color: tuple, filling: float) -> tuple:
+        step = round(min(1, max(0, filling)) * self.OVERLAY_STEPS)
+        key = (shape, tuple(color), step)
+        overlay = self._overlays.get(key)
+        if overlay is None:
+            if len(self._overlays) >= self.MAX_CACHED_OVERLAYS:
+                self._overlays.clear()
+            overlay = self._overlays[key] = self._build_overlay(shape, color, step / self.OVERLAY_STEPS)
+        return overlay
+
+    def _draw_ui(self, frame):
+        """
+        :param frame: C-contiguous BGR image, drawn in place
+        """
+        indexes, premultiplied, alpha_inv = self._get_overlay(frame.shape[:2], self.rect_color, self.filling)
+        pixels = frame.reshape(-1, 3)
+        covered = pixels[indexes]
+        self._blend(covered, premultiplied, alpha_inv)
+        pixels[indexes] = covered
 
     def _refresh_ui(self):
         if self.current_frame is None:
             return
 
-        frame = self.current_frame.copy()
+        frame = self._copy_to_canvas(self.current_frame)
 
         self._draw_ui(frame)
         cv2.imshow("Display", frame)
 
-    def show_camera_image(self, frame):
+    def _copy_to_canvas(self, frame):
+        # the canvas is reused between frames; current_frame stays clean for _refresh_ui
+        if self._canvas is None or self._canvas.shape != frame.shape:
+            self._canvas = np.empty_like(frame)
+        np.copyto(self._canvas, frame)
+        return self._canvas
 
-        frame = frame.copy()
+    def show_camera_image(self, frame):
+        """
+        Shows the frame cropped to the display aspect ratio and scaled to the display size.
+        The frame itself is not modified.
+        """
         h, w = frame.shape[:2]
 
         t_ratio = cfg.DISPLAY_WIDTH / cfg.DISPLAY_HEIGHT
@@ -143,15 +290,17 @@ class Display:
         else:
             nh = w / t_ratio
 
+        # a view, resize reads it directly
         frame = frame[int(h / 2 - nh / 2):int(h / 2 + nh / 2), int(w / 2 - nw / 2):int(w / 2 + nw / 2)]
 
-        frame = cv2.resize(frame, (cfg.DISPLAY_WIDTH, cfg.DISPLAY_HEIGHT))
+        if self.current_frame is None or self.current_frame.shape[:2] != (cfg.DISPLAY_HEIGHT, cfg.DISPLAY_WIDTH) or self.current_frame.dtype != frame.dtype:
+            self.current_frame = np.empty((cfg.DISPLAY_HEIGHT, cfg.DISPLAY_WIDTH) + frame.shape[2:], dtype=frame.dtype)
+        cv2.resize(frame, (cfg.DISPLAY_WIDTH, cfg.DISPLAY_HEIGHT), dst=self.current_frame)
 
-        self.current_frame = frame.copy()
+        frame = self._copy_to_canvas(self.current_frame)
 
         self._draw_ui(frame)
 
         cv2.imshow("Display", frame)
 
-        if cv2.waitKey(1) == ord('q'):
-            exit()
+        self._poll_keys()
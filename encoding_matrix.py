@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import numpy
+from dataclasses import dataclass
+from typing import Any, Hashable
+
+
+@dataclass
+class MatchResult:
+    key: Any
+    slot: int
+    distance: float
+    second_distance: float    # distance to the runner-up; inf if there is only one candidate
+
+
+class EncodingMatrix:
+    """
+    Contiguous float32 N×128 storage of face encodings.
+
+    Every encoding occupies a stable slot (row) that is assigned on `add` and freed on `remove`.
+    Freed slots are reused, so the matrix is never compacted and slot numbers stay valid while the key is stored.
+    Squared norms and an additive penalty (0 for active rows, inf for inactive or free rows) are maintained
+    alongside the rows so `match` is a single matrix-vector product with no per-call Python-level copying.
+    """
+
+    ENCODING_SIZE = 128
+    INITIAL_CAPACITY = 64
+
+    _data: numpy.ndarray
+    _sq_norms: numpy.ndarray
+    _penalty: numpy.ndarray
+    _scratch: numpy.ndarray
+    _keys: list
+    _slots: dict
+    _free: list
+    _size: int    # number of slots ever used (high-water mark)
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        capacity = max(1, capacity)
+        self._data = numpy.zeros((capacity, self.ENCODING_SIZE), dtype=numpy.float32)
+        self._sq_norms = numpy.zeros(capacity, dtype=numpy.float32)
+        self._penalty = numpy.full(capacity, numpy.inf, dtype=numpy.float32)
+        self._scratch = numpy.empty(capacity, dtype=numpy.float32)
+        self._keys = [None] * capacity
+        self._slots = {}
+        self._free = []
+        self._size = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key: Hashable):
+        return key in self._slots
+
+    @property
+    def capacity(self) -> int:
+        return self._data.shape[0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def data(self) -> numpy.ndarray:
+        """Read-only view of the used rows. Free rows are zeroed and have an infinite penalty."""
+        view = self._data[:self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def penalty(self) -> numpy.ndarray:
+        return self._penalty[:self._size]
+
+    def _grow(self, min_capacity: int):
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+
+        data = numpy.zeros((capacity, self.ENCODING_SIZE), dtype=numpy.float32)
+        data[:self._size] = self._data[:self._size]
+        sq_norms = numpy.zeros(capacity, dtype=numpy.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        penalty = numpy.full(capacity, numpy.inf, dtype=numpy.float32)
+        penalty[:self._size] = self._penalty[:self._size]
+
+        self._data, self._sq_norms, self._penalty = data, sq_norms, penalty
+        self._scratch = numpy.empty(capacity, dtype=numpy.float32)
+        self._keys.extend([None] * (capacity - len(self._keys)))
+
+    def _take_slot(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._size >= self.capacity:
+            self._grow(self._size + 1)
+        self._size += 1
+        return self._size - 1
+
+    def add(self, key: Hashable, encoding, active: bool = True) -> int:
+        if key in self._slots:
+            raise KeyError(f"Key {key} is already stored in the matrix")
+
+        row = numpy.asarray(encoding, dtype=numpy.float32)
+        if row.shape != (self.ENCODING_SIZE, ):
+            raise ValueError(f"Encoding must have shape ({self.ENCODING_SIZE}, ), got {row.shape}")
+
+        slot = self._take_slot()
+        self._data[slot] = row
+        self._sq_norms[slot] = numpy.dot(row, row)
+        self._penalty[slot] = 0 if active else numpy.inf
+        self._keys[slot] = key
+        self._slots[key] = slot
+        return slot
+
+    def remove(self, key: Hashable) -> int:
+        slot = self._slots.pop(key)
+        self._data[slot] = 0
+        self._sq_norms[slot] = 0
+        self._penalty[slot] = numpy.inf
+        self._keys[slot] = None
+        self._free.append(slot)
+        return slot
+
+    def set_active(self, key: Hashable, active: bool):
+        self._penalty[self._slots[key]] = 0 if active else numpy.inf
+
+    def is_active(self, key: Hashable) -> bool:
+        return self._penalty[self._slots[key]] == 0
+
+    def occupied_slots(self) -> numpy.ndarray:
+        """Sorted slots that currently hold an encoding, including inactive ones."""
+        slots = numpy.fromiter(self._slots.values(), dtype=numpy.int64, count=len(self._slots))
+        slots.sort()
+        return slots
+
+    def get_slot(self, key: Hashable) -> int:
+        return self._slots[key]
+
+    def key_at(self, slot: int) -> Any:
+        return self._keys[slot]
+
+    def row(self, slot: int) -> numpy.ndarray:
+        return self._data[slot]
+
+    def distances(self, target) -> numpy.ndarray:
+        """
+        Euclidean distances from `target` to every used slot (inactive and free slots are inf).
+        The returned array is an internal scratch buffer that is overwritten by the next call.
+        """
+        n = self._size
+        out = self._scratch[:n]
+        if n == 0:
+            return out
+
+        target = numpy.asarray(target, dtype=numpy.float32)
+
+        # |a - t|² = |a|² - 2 a·t + |t|²
+        numpy.dot(self._data[:n], target, out=out)
+        out *= -2
+        out += self._sq_norms[:n]
+        out += numpy.dot(target, target)
+        numpy.maximum(out, 0, out=out)
+        numpy.sqrt(out, out=out)
+        out += self._penalty[:n]
+        return out
+
+    def distances_to_slots(self, target, slots: numpy.ndarray) -> numpy.ndarray:
+        """Exact distances from `target` to the given slots (inactive and free slots are inf)."""
+        target = numpy.asarray(target, dtype=numpy.float32)
+        result = self._data[slots] @ target
+        result *= -2
+        result += self._sq_norms[slots]
+        result += numpy.dot(target, target)
+        numpy.maximum(result, 0, out=result)
+        numpy.sqrt(result, out=result)
+        result += self._penalty[slots]
+        return result
+
+    def match(self, target) -> MatchResult | None:
+        """
+        Finds the nearest active encoding to `target`.
+        :return: None if there are no active encodings
+        """
+        return self.best_of(self.distances(target))
+
+    def match_many(self, targets) -> list:
+        """
+        Finds the nearest active encoding for every row of `targets` with one matrix-matrix product.
+        :return: `MatchResult` or None per target
+        """
+        targets = numpy.asarray(targets, dtype=numpy.float32).reshape(-1, self.ENCODING_SIZE)
+        n = self._size
+        if n == 0:
+            return [None] * len(targets)
+
+        distances = targets @ self._data[:n].T
+        distances *= -2
+        distances += self._sq_norms[:n]
+        distances += numpy.einsum("ij,ij->i", targets, targets)[:, numpy.newaxis]
+        numpy.maximum(distances, 0, out=distances)
+        numpy.sqrt(distances, out=distances)
+        distances += self._penalty[:n]
+        return [self.best_of(row) for row in distances]
+
+    def best_of(self, distances: numpy.ndarray, slots: numpy.ndarray = None) -> MatchResult | None:
+        """
+        Picks the best and the runner-up distance from `distances`.
+        :param slots: slot numbers of `distances` elements; defaults to the element index
+        """
+        if len(distances) == 0:
+            return None
+
+        best = int(numpy.argmin(distances))
+        best_distance = float(distances[best])
+        if best_distance == numpy.inf:
+            return None
+
+        # temporarily hide the best element instead of sorting or copying the array
+        distances[best] = numpy.inf
+        second_distance = float(distances.min())
+        distances[best] = best_distance
+
+        slot = best if slots is None else int(slots[best])
+        return MatchResult(self._keys[slot], slot, best_distance, second_distance)
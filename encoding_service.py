@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import numpy
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import shared_memory, resource_tracker
+from logger import logger
+
+import face_detection
+
+
+# worker process state
+
+_recognizer: face_detection.Recognizer | None = None
+_own_tracker = False    # the worker runs its own resource tracker instead of sharing the parent's
+
+
+def _init_worker(forked: bool = True):
+    """
+    :param forked: the worker was forked; forked workers start their own resource tracker,
+        spawned ones share the parent's
+    """
+    global _recognizer, _own_tracker
+    _own_tracker = forked
+    _recognizer = face_detection.Recognizer()
+    face_detection.load_models()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches a block for one job. The block is closed after the job, so the worker doesn't keep
+    the blocks the parent has unlinked mapped.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    # the block is owned and unlinked by the parent process; don't let the worker's tracker unlink it on exit
+    if _own_tracker:
+        try:
+            resource_tracker.unregister(block._name, "shared_memory")
+        except Exception:
+            pass
+    return block
+
+
+def _encode_in_worker(block_name: str, shape: tuple, dtype: str, bounds, num_jitters: int, model: str) -> numpy.ndarray:
+    block = _attach(block_name)
+    try:
+        image = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf)
+        encoding = numpy.asarray(_recognizer.get_face_encoding(image, bounds, num_jitters=num_jitters, model=model), dtype=numpy.float32)
+        # the view must be gone before the block is closed
+        del image
+        return encoding
+    finally:
+        block.close()
+
+
+def _encode_batch_in_worker(images: list, bounds: list, num_jitters: int, model: str) -> list:
+    """
+    :param images: (block name, shape, dtype) per image
+    """
+    blocks = []
+    try:
+        arrays = []
+        for name, shape, dtype in images:
+            blocks.append(_attach(name))
+            arrays.append(numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=blocks[-1].buf))
+        encodings = [e if isinstance(e, Exception) else numpy.asarray(e, dtype=numpy.float32)
+                     for e in _recognizer.get_face_encodings_batch(arrays, bounds, num_jitters, model)]
+        del arrays
+        return encodings
+    finally:
+        for block in blocks:
+            block.close()
+
+
+# parent process side
+
+class EncodingService:
+    """
+    Computes face encodings in a pool of worker processes, each with its own `Recognizer`.
+
+    Images are passed to the workers through reusable shared memory blocks instead of being pickled;
+    only the block name, shape and face bounds travel through the pool's queue.
+    Where 'fork' is available the pool is created with it, so it must be started before camera and display threads.
+    """
+
+    MAX_FREE_BLOCKS = 8
+
+    workers: int
+
+    _executor: ProcessPoolExecutor | None
+    _warmup: Future | None    # done when a worker has loaded the models
+    _free_blocks: list
+    _all_blocks: list
+
+    def __init__(self, workers: int = 0):
+        """
+        :param workers: number of worker processes. 0 - one per CPU core.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._warmup = None
+        self._free_blocks = []
+        self._all_blocks = []
+
+    def start(self):
+        if self._executor is not None:
+            return
+        # Windows (the debug setup) has no 'fork'; the workers are spawned there and import this module anew
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method),
+                                             initializer=_init_worker, initargs=(method == "fork", ))
+        # with 'fork' the executor launches all workers on the first submit; do it now, while the process is still single-threaded.
+        # The workers load the models in the background, see `wait_ready`
+        self._warmup = self._executor.submit(os.getpid)
+        logger.info(f"Started encoding service with {self.workers} workers")
+
+    async def wait_ready(self):
+        """Waits until a worker has loaded the models."""
+        if self._executor is None:
+            self.start()
+        await asyncio.wrap_future(self._warmup)
+
+    def _take_block(self, size: int) -> shared_memory.SharedMemory:
+        for i, block in enumerate(self._free_blocks):
+            if block.size >= size:
+                return self._free_blocks.pop(i)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._all_blocks.append(block)
+        return block
+
+    def _release_block(self, block: shared_memory.SharedMemory):
+        if self._executor is None:
+            return
+        if len(self._free_blocks) < self.MAX_FREE_BLOCKS:
+            self._free_blocks.append(block)
+        else:
+            self._all_blocks.remove(block)
+            block.close()
+            block.unlink()
+
+    def encode(self, image: numpy.ndarray, bounds: list = None,
+               num_jitters: int = face_detection.Recognizer.NUM_JITTERS,
+               model: str = face_detection.Recognizer.ENCODING_MODEL) -> asyncio.Future:
+        """
+        Schedules encoding of the face in `image`. Must be called from the event loop.
+        The image is copied into shared memory before returning, so the caller may reuse it immediately.
+        :return: a future with the encoding as float32 numpy.ndarray; raises `NoFacesDetectedException`
+        """
+        if self._executor is None:
+            self.start()
+
+        block, (name, shape, dtype) = self._share(image)
+        return self._submit([block], _encode_in_worker, name, shape, dtype, bounds, num_jitters, model)
+
+    def _submit(self, blocks: list, fn, *args) -> asyncio.Future:
+        """
+        Submits a job reading `blocks`. The blocks are released when the job itself is done, not when the returned
+        future is: a cancelled future is done at once while the worker may still be reading the image.
+        """
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(fn, *args)
+
+        def release():
+            for block in blocks:
+                self._release_block(block)
+
+        def on_job_done(_):
+            # called in a thread of the executor
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                # the loop is closed; `shutdown` releases all blocks
+                pass
+
+        job.add_done_callback(on_job_done)
+        return asyncio.wrap_future(job, loop=loop)
+
+    def _share(self, image: numpy.ndarray) -> tuple:
+        image = numpy.ascontiguousarray(image)
+        block = self._take_block(image.nbytes)
+        numpy.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+        return block, (block.name, image.shape, image.dtype.str)
+
+    def encode_batch(self, images: list, bounds: list,
+                     num_jitters: int = face_detection.Recognizer.NUM_JITTERS,
+                     model: str = face_detection.Recognizer.ENCODING_MODEL) -> asyncio.Future:
+        """
+        Schedules encoding of one face per image as a single job. Must be called from the event loop.
+        :param bounds: face bounds (top, right, bottom, left) per image
+        :return: a future with a list of float32 encodings or `NoFacesDetectedException` per image
+        """
+        if self._executor is None:
+            self.start()
+
+        shared = [self._share(image) for image in images]
+        return self._submit([block for block, _ in shared], _encode_batch_in_worker,
+                            [description for _, description in shared], list(bounds), num_jitters, model)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            self._warmup = None
+
+        for block in self._all_blocks:
+            block.close()
+            block.unlink()
+        self._all_blocks.clear()
+        self._free_blocks.clear()
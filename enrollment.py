@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Awaitable, AsyncIterator
+import cv2
+import numpy
+from logger import logger
+from user_store import EncodedUserStore
+
+
+@dataclass
+class EnrollmentProgress:
+    total: int
+    done: int = 0
+    cached: int = 0
+    failed: int = 0
+
+
+class EncodingCache:
+    """
+    Encodings of enrolled images by the SHA-256 of the file content, so a photo dropped again or a copy
+    of it is not encoded twice. Kept in an `EncodedUserStore`: the ID is the first 8 bytes of the digest
+    and the name is the full hex digest.
+    """
+
+    _store: EncodedUserStore
+    _encodings: dict | None    # hex digest -> encoding
+
+    def __init__(self, directory: str, name: str = "enrollment_cache"):
+        self._store = EncodedUserStore(directory, name)
+        self._encodings = None
+
+    @staticmethod
+    def _key(digest: str) -> int:
+        return int.from_bytes(bytes.fromhex(digest)[:8], "little", signed=True)
+
+    def _load(self):
+        if self._encodings is None:
+            self._encodings = {u.name: u.encoding for u in self._store.load()} if self._store.exists() else {}
+
+    def get(self, digest: str) -> numpy.ndarray | None:
+        self._load()
+        return self._encodings.get(digest)
+
+    def put(self, digest: str, encoding: numpy.ndarray):
+        self._load()
+        if digest in self._encodings or self._key(digest) in self._store:
+            return
+        self._store.append(self._key(digest), digest, encoding)
+        self._encodings[digest] = encoding
+
+
+def _read_file(path: str) -> tuple:
+    """
+    :return: (hex SHA-256 of the content, content)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def _decode(data: bytes) -> numpy.ndarray:
+    image = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("the file is not a supported image")
+    return image
+
+
+async def encode_images(paths: list, encode: Callable[[numpy.ndarray], Awaitable], cache: EncodingCache = None,
+                        concurrency: int = 4, progress: Callable[[EnrollmentProgress], None] = None) -> AsyncIterator:
+    """
+    Reads, decodes and encodes the images in parallel. Files are read and decoded in the default executor;
+    `encode` should run on other cores, e.g. `EncodingService.encode`. Files with the same content are encoded once.
+    :param concurrency: images in flight at once; bounds the memory taken by decoded images
+    :param progress: called after every image
+    :return: async iterator of (path, encoding or exception) in completion order
+    """
+    loop = asyncio.get_running_loop()
+    state = EnrollmentProgress(len(paths))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    in_flight = {}    # digest -> future of the encoding, shared by files with the same content
+
+    async def encode_file(path: str):
+        async with semaphore:
+            digest, data = await loop.run_in_executor(None, _read_file, path)
+            encoding = cache.get(digest) if cache is not None else None
+            if encoding is not None:
+                state.cached += 1
+                return path, encoding
+
+            shared = in_flight.get(digest)
+            if shared is not None:
+                state.cached += 1
+                return path, await asyncio.shield(shared)
+
+            shared = in_flight[digest] = loop.create_future()
+            try:
+                image = await loop.run_in_executor(None, _decode, data)
+                del data
+                encoding = numpy.asarray(await encode(image), dtype=numpy.float32)
+            except Exception as ex:
+                shared.set_exception(ex)
+                # don't report an exception that no duplicate awaited
+                shared.exception()
+                raise
+            shared.set_result(encoding)
+            if cache is not None:
+                cache.put(digest, encoding)
+            return path, encoding
+
+    async def guarded(path: str):
+        try:
+            return await encode_file(path)
+        except Exception as ex:
+            return path, ex
+
+    for completed in asyncio.as_completed([guarded(path) for path in paths]):
+        path, result = await completed
+        state.done += 1
+        if isinstance(result, Exception):
+            state.failed += 1
+        if progress is not None:
+            progress(state)
+        yield path, result
+
+
+class ProgressLogger:
+    """Logs the enrollment progress at most once per `interval` seconds and at the end."""
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self._started = time.perf_counter()
+        self._last = self._started
+
+    def __call__(self, progress: EnrollmentProgress):
+        now = time.perf_counter()
+        if progress.done < progress.total and now - self._last < self.interval:
+            return
+        self._last = now
+        rate = progress.done / max(now - self._started, 1e-6)
+        logger.info(f"Enrolled {progress.done}/{progress.total} images ({progress.cached} from cache, {progress.failed} failed), "
+                    f"{rate:.1f} images/s")
+
+
+def list_images(directory: str) -> list:
+    """
+    :return: paths of the *.png and *.jpg files of the directory, sorted
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if os.path.splitext(name)[1].lower() in (".png", ".jpg") and os.path.isfile(os.path.join(directory, name)))
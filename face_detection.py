@@ -1,12 +1,12 @@
 import traceback
 
-import face_recognition as recog
 import cv2
 import numpy
 from debug import debug_cfg
 import os
-
-import users
+import time
+from typing import Callable, Awaitable, Any
+from logger import logger
 
 
 class NoFacesDetectedException(Exception):
@@ -19,13 +19,49 @@ else:
     from rpi import rpi_cfg as cfg
 
 
+recog = None    # face_recognition module, see load_models
+
+
+def load_models():
+    """
+    Imports face_recognition, which loads the dlib models and takes seconds.
+    Only the encoding methods need the models, so detection is available before this is called.
+    """
+    global recog
+    if recog is None:
+        import face_recognition
+        recog = face_recognition
+    return recog
+
+
 class Recognizer:
 
-    def __init__(self):
+    MATCHING_THRESHOLD = 0.5
+    NUM_JITTERS = 5
+    ENCODING_MODEL = "large"
+    JITTER_TIERS = (1, NUM_JITTERS)
+    AMBIGUITY_BAND = 0.1
+
+    MIN_FACE_SIZE = 80
+
+    jitter_tiers: tuple
+    ambiguity_band: float
+    detection_downscale: float
+
+    def __init__(self, jitter_tiers: tuple = JITTER_TIERS, ambiguity_band: float = AMBIGUITY_BAND, detection_downscale: float = 1):
+        """
+        :param jitter_tiers: numbers of jitters to encode with, in order of escalation
+        :param ambiguity_band: a match is re-encoded with the next tier if its distance is within this band around MATCHING_THRESHOLD
+        :param detection_downscale: images are shrunk by this factor before Haar detection
+        """
         self.face_cascade = cv2.CascadeClassifier("haarcascade_frontalface_alt.xml")
+        self.detection_downscale = max(1, detection_downscale)
+        self.jitter_tiers = tuple(jitter_tiers) or (self.NUM_JITTERS, )
+        self.ambiguity_band = ambiguity_band
 
-    def get_face_encoding(self, image: numpy.ndarray, bounds: list = None):
-        encodings = recog.face_encodings(image, known_face_locations=bounds, num_jitters=5, model="large")
+    def get_face_encoding(self, image: numpy.ndarray, bounds: list = None, num_jitters: int = NUM_JITTERS, model: str = ENCODING_MODEL):
+        load_models()
+        encodings = recog.face_encodings(image, known_face_locations=bounds, num_jitters=num_jitters, model=model)
 
         #cv2.imwrite("recog_img.png", image)
 
@@ -33,39 +69,134 @@ class Recognizer:
             raise NoFacesDetectedException
         return encodings[0]
 
+    def get_face_encodings_batch(self, images: list, bounds: list, num_jitters: int = NUM_JITTERS, model: str = ENCODING_MODEL) -> list:
+        """
+        Encodes one face per image with a single batched call of the dlib resnet.
+        :param bounds: face bounds per image
+        :return: encoding or `NoFacesDetectedException` per image
+        """
+        load_models()
+        landmarks = [recog.api._raw_face_landmarks(image, [face], model) for image, face in zip(images, bounds)]
+        batch = [i for i, found in enumerate(landmarks) if len(found) > 0]
+        results = [NoFacesDetectedException() for _ in images]
+        if not batch:
+            return results
+
+        try:
+            descriptors = recog.api.face_encoder.compute_face_descriptor(
+                [images[i] for i in batch], [landmarks[i] for i in batch], num_jitters
+            )
+            for i, image_descriptors in zip(batch, descriptors):
+                results[i] = numpy.array(image_descriptors[0])
+        except (TypeError, AttributeError, RuntimeError):
+            # dlib builds without batch support
+            for i in batch:
+                try:
+                    results[i] = self.get_face_encoding(images[i], [bounds[i]], num_jitters, model)
+                except NoFacesDetectedException as ex:
+                    results[i] = ex
+        return results
+
     def get_face_encoding_from_file(self, file_path: str):
         image = cv2.imread(file_path)
         return self.get_face_encoding(image)
 
-    def find_face(self, image: numpy.ndarray):
-
+    def prepare_detection_image(self, image: numpy.ndarray, region: tuple = None) -> numpy.ndarray:
+        """
+        Crops the image to the region, converts it to grayscale and shrinks it by `detection_downscale`.
+        Crop is a view, so only the region is converted and resized.
+        """
+        if region is not None:
+            top, right, bottom, left = region
+            image = image[top:bottom, left:right]
+
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        if self.detection_downscale > 1:
+            h, w = image.shape[:2]
+            size = (max(1, int(w / self.detection_downscale)), max(1, int(h / self.detection_downscale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+        return image
+
+    def find_face(self, image: numpy.ndarray, region: tuple = None):
+        """
+        :param region: (top, right, bottom, left) part of the image to search in. The whole image by default.
+        :return: face bounds (top, right, bottom, left) in the coordinates of the whole image
+        """
+        top, left = (region[0], region[3]) if region is not None else (0, 0)
+        prepared = self.prepare_detection_image(image, region)
+        # scale factors of each axis after rounding of the downscaled size
+        scale_y = (image.shape[0] if region is None else region[2] - region[0]) / prepared.shape[0]
+        scale_x = (image.shape[1] if region is None else region[1] - region[3]) / prepared.shape[1]
+
+        min_size = max(1, int(self.MIN_FACE_SIZE / self.detection_downscale))
         faces = self.face_cascade.detectMultiScale(
-                image,
+                prepared,
                 scaleFactor=1.4,
                 minNeighbors=3,
-                minSize=(80, 80)
+                minSize=(min_size, min_size)
         )
         if len(faces) == 0:
             return None
 
         x, y, w, h = faces[0]
-        x0, x1 = int(x), int(x + w)
-        y0, y1 = int(y), int(y + h)
+        x0, x1 = int(x * scale_x) + left, int((x + w) * scale_x) + left
+        y0, y1 = int(y * scale_y) + top, int((y + h) * scale_y) + top
         face = (y0, x1, y1, x0)
         return face
 
     def get_matching_encoding_index(self, target_encoding: list, encodings: list):
-        if not any(encodings):
+        if len(encodings) == 0:
             return -1
 
-        compared = list(recog.face_distance(encodings, target_encoding))
-        m = min(compared)
-        if m > 0.5:
-            return -1
-        try:
-            return compared.index(m)
-        except ValueError as ex:
+        load_models()
+        compared = recog.face_distance(numpy.asarray(encodings), target_encoding)
+        index = int(numpy.argmin(compared))
+        if compared[index] > self.MATCHING_THRESHOLD:
             return -1
+        return index
+
+    def is_match(self, distance: float) -> bool:
+        return distance <= self.MATCHING_THRESHOLD
+
+    def is_ambiguous(self, distance: float) -> bool:
+        return abs(distance - self.MATCHING_THRESHOLD) <= self.ambiguity_band
+
+    async def identify_tiered(self, count: int, encode: Callable[[list, int], Awaitable[list]], match: Callable[[list], list]) -> list:
+        """
+        Identifies a batch of faces. All faces are encoded with the cheapest jitter tier; only the faces
+        whose best distance is ambiguous are re-encoded, together, with the next tier.
+        :param count: number of faces in the batch
+        :param encode: takes face indexes and the number of jitters and returns an awaitable list of encodings or exceptions
+        :param match: takes a list of encodings and returns a `MatchResult` or None per encoding
+        :return: the match result of the deciding tier or the encoding exception per face
+        """
+        started = time.perf_counter()
+        results = [None] * count
+        pending = list(range(count))
+        for tier, num_jitters in enumerate(self.jitter_tiers):
+            encodings = await encode(pending, num_jitters)
+            encoded = [(i, e) for i, e in zip(pending, encodings) if not isinstance(e, Exception)]
+            for i, e in zip(pending, encodings):
+                if isinstance(e, Exception):
+                    results[i] = e
+
+            last_tier = tier == len(self.jitter_tiers) - 1
+            pending = []
+            for (i, _), result in zip(encoded, match([e for _, e in encoded])):
+                results[i] = result
+                if result is not None and self.is_ambiguous(result.distance) and not last_tier:
+                    pending.append(i)
+                    continue
+                distance = f"{result.distance:.3f}" if result is not None else "none"
+                logger.info(f"Identification decided by tier {tier} ({num_jitters} jitters): distance {distance}, "
+                            f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+            if not pending:
+                break
+        return results
 
 
 
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import itertools
+import numpy
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class Track:
+    track_id: int
+    face: tuple    # (top, right, bottom, left), the same format as Recognizer.find_face
+    misses: int = 0
+
+
+def overlap(a: tuple, b: tuple) -> float:
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    if bottom <= top or right <= left:
+        return 0
+    intersection = (bottom - top) * (right - left)
+    union = (a[2] - a[0]) * (a[1] - a[3]) + (b[2] - b[0]) * (b[1] - b[3]) - intersection
+    return intersection / union
+
+
+class FaceTracker:
+    """
+    Follows a single face between frames of one camera.
+
+    While a face is tracked, detection runs only in a region around its last box. Full-frame detection runs
+    every `redetect_interval` frames and when the face isn't found in the region. A track survives up to
+    `MAX_MISSES` frames without a face, so short detection failures don't change its ID.
+    """
+
+    MAX_MISSES = 2
+    SAME_FACE_OVERLAP = 0.3
+
+    _ids = itertools.count(1)    # track IDs are unique across all cameras
+
+    redetect_interval: int
+    search_margin: float
+    track: Track | None
+
+    _frames_since_full: int
+
+    def __init__(self, redetect_interval: int = 10, search_margin: float = 0.5):
+        """
+        :param redetect_interval: number of frames between full-frame detections while a face is tracked
+        :param search_margin: margin added to each side of the last box, as a fraction of its size
+        """
+        self.redetect_interval = redetect_interval
+        self.search_margin = search_margin
+        self.track = None
+        self._frames_since_full = 0
+
+    def reset(self):
+        self.track = None
+
+    def _search_region(self, zone: tuple) -> tuple | None:
+        top, right, bottom, left = self.track.face
+        margin_y = int((bottom - top) * self.search_margin)
+        margin_x = int((right - left) * self.search_margin)
+        region = (max(zone[0], top - margin_y), min(zone[1], right + margin_x),
+                  min(zone[2], bottom + margin_y), max(zone[3], left - margin_x))
+        if region[2] <= region[0] or region[1] <= region[3]:
+            return None
+        return region
+
+    def update(self, frame: numpy.ndarray, find_face: Callable, zone: tuple = None) -> Track | None:
+        """
+        :param find_face: `Recognizer.find_face`; called with the frame and a search region
+        :param zone: (top, right, bottom, left) part of the frame where faces are detected. The whole frame by default.
+        :return: the track if a face was found on this frame
+        """
+        if zone is None:
+            zone = (0, frame.shape[1], frame.shape[0], 0)
+
+        face = None
+        full_detection = self.track is None or self._frames_since_full + 1 >= self.redetect_interval
+        if not full_detection:
+            region = self._search_region(zone)
+            if region is not None:
+                face = find_face(frame, region)
+            full_detection = face is None
+
+        if full_detection:
+            self._frames_since_full = 0
+            face = find_face(frame, zone)
+        else:
+            self._frames_since_full += 1
+
+        if face is None:
+            if self.track is not None:
+                self.track.misses += 1
+                if self.track.misses > self.MAX_MISSES:
+                    self.track = None
+            return None
+
+        if self.track is None or overlap(self.track.face, face) < self.SAME_FACE_OVERLAP:
+            self.track = Track(next(self._ids), face)
+        else:
+            self.track.face = face
+            self.track.misses = 0
+        return self.track
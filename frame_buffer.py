@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import threading
+import time
+import numpy
+
+
+class Frame:
+    """
+    A frame published to a `FrameRing`. `image` is the ring's buffer itself, not a copy.
+    A taken frame is pinned: the ring doesn't write into its buffer until `release` is called.
+    """
+
+    image: numpy.ndarray
+    sequence: int
+    timestamp: float    # time.monotonic() when the frame was captured
+
+    _ring: FrameRing
+    _slot: int
+    _pinned: bool
+
+    def __init__(self, ring: FrameRing, slot: int, image: numpy.ndarray, sequence: int, timestamp: float):
+        self._ring = ring
+        self._slot = slot
+        self._pinned = False
+        self.image = image
+        self.sequence = sequence
+        self.timestamp = timestamp
+
+    @property
+    def age(self) -> float:
+        """Seconds since the frame was captured."""
+        return time.monotonic() - self.timestamp
+
+    def release(self):
+        if self._pinned:
+            self._pinned = False
+            self._ring._unpin(self._slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FrameRing:
+    """
+    A small ring of frame buffers owned by one writer.
+
+    The writer `claim`s a slot, fills its buffer in place (the buffer is None until the first frame, or may be
+    replaced if the frame shape changes) and `publish`es it. Consumers `take` the latest frame without copying.
+    Neither the latest nor pinned slots are ever claimed; if every slot is in use the ring grows by one buffer.
+    """
+
+    _buffers: list
+    _pins: list
+    _latest: Frame | None
+    _sequence: int
+    _next: int
+
+    def __init__(self, size: int = 4):
+        self._buffers = [None] * max(2, size)
+        self._pins = [0] * len(self._buffers)
+        self._latest = None
+        self._sequence = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    @property
+    def latest(self) -> Frame | None:
+        """The latest frame without pinning it; only safe to use on the writer's side."""
+        return self._latest
+
+    def claim(self) -> tuple:
+        """
+        :return: (slot, buffer). The buffer is None if the slot wasn't used yet.
+        """
+        with self._lock:
+            latest_slot = self._latest._slot if self._latest is not None else -1
+            for offset in range(len(self._buffers)):
+                slot = (self._next + offset) % len(self._buffers)
+                if self._pins[slot] == 0 and slot != latest_slot:
+                    self._next = (slot + 1) % len(self._buffers)
+                    return slot, self._buffers[slot]
+
+            self._buffers.append(None)
+            self._pins.append(0)
+            return len(self._buffers) - 1, None
+
+    def publish(self, slot: int, image: numpy.ndarray, timestamp: float = None) -> Frame:
+        """
+        :param image: the filled buffer of the slot; replaces the slot's buffer if the writer had to reallocate it
+        """
+        with self._lock:
+            self._buffers[slot] = image
+            self._sequence += 1
+            self._latest = Frame(self, slot, image, self._sequence, timestamp if timestamp is not None else time.monotonic())
+            return self._latest
+
+    def take(self, newer_than: int = 0) -> Frame | None:
+        """
+        Pins and returns the latest frame if its sequence number is greater than `newer_than`.
+        The caller must `release` the frame.
+        """
+        with self._lock:
+            latest = self._latest
+            if latest is None or latest.sequence <= newer_than:
+                return None
+            self._pins[latest._slot] += 1
+            frame = Frame(self, latest._slot, latest.image, latest.sequence, latest.timestamp)
+            frame._pinned = True
+            return frame
+
+    def _unpin(self, slot: int):
+        with self._lock:
+            self._pins[slot] -= 1
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class CachedIdentity:
+    user: Any    # None if the face didn't match anybody
+    expires: float
+
+
+class IdentityCache:
+    """
+    Identification results of tracked faces, keyed by camera index and track ID.
+
+    Both positive and negative results are cached, so a person standing in front of a camera is encoded once per TTL.
+    A positive result is dropped as soon as its user can't enter anymore because of deactivation or removal;
+    the row limit of `User.can_enter` is temporary and is still checked by the caller on every attempt.
+    Negative results are dropped when a user is added, because the new user may be the unknown face.
+    The caller drops the result of a track with `invalidate` when the track can't be trusted to still be the same person,
+    e.g. after the detector didn't look at the camera while the lock was open.
+    Subscribe `on_user_event` to `UserManager.user_listeners` to receive these changes.
+    """
+
+    ttl: float
+    negative_ttl: float
+
+    _entries: dict
+
+    def __init__(self, ttl: float, negative_ttl: float):
+        """
+        :param ttl: seconds to keep a positive result
+        :param negative_ttl: seconds to keep a negative result
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, camera_index: int, track_id: int) -> CachedIdentity | None:
+        key = (camera_index, track_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry.expires <= time.monotonic() or (entry.user is not None and not entry.user.is_active):
+            del self._entries[key]
+            return None
+        return entry
+
+    def put(self, camera_index: int, track_id: int, user: Any):
+        now = time.monotonic()
+        # entries of tracks that are gone are never read again; clean them up here
+        for key in [k for k, e in self._entries.items() if e.expires <= now]:
+            del self._entries[key]
+
+        self._entries[(camera_index, track_id)] = CachedIdentity(user, now + (self.ttl if user is not None else self.negative_ttl))
+
+    def invalidate(self, camera_index: int, track_id: int):
+        self._entries.pop((camera_index, track_id), None)
+
+    def invalidate_user(self, user: Any):
+        for key in [k for k, e in self._entries.items() if e.user is user]:
+            del self._entries[key]
+
+    def invalidate_unknown(self):
+        for key in [k for k, e in self._entries.items() if e.user is None]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def on_user_event(self, event: str, user: Any):
+        if event == "add":
+            self.invalidate_unknown()
+        elif event == "remove" or (event == "update" and not user.is_active):
+            self.invalidate_user(user)
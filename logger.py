@@ -11,19 +11,26 @@ if debug:
 else:
     from rpi import rpi_cfg as cfg
 
-logger = logging.getLogger("test")
 
-if not os.path.exists(cfg.LOGS_PATH):
-    os.mkdir(cfg.LOGS_PATH)
+class LazyFileHandler(logging.FileHandler):
+    """Creates the logs directory and the file with the first record instead of at import."""
+
+    def __init__(self, filename: str, mode: str = "a", encoding: str = None):
+        super().__init__(filename, mode, encoding, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
 filename = os.path.join(cfg.LOGS_PATH, f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.log")
 
 logger = logging.getLogger("FaceRecognitionMain")
 logger.setLevel(logging.DEBUG if debug else logging.INFO)
 streamHandler = logging.StreamHandler(sys.stdout)
-fileHandler = logging.FileHandler(filename, mode="w")
+fileHandler = LazyFileHandler(filename, mode="w")
 formatter = logging.Formatter("[%(asctime)s %(levelname)s] %(message)s")
 fileHandler.setFormatter(formatter)
 logger.addHandler(fileHandler)
 logger.addHandler(streamHandler)
-logger.debug(f"Logging to the '{filename}'")
 
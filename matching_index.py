@@ -0,0 +1,330 @@
+from __future__ import annotations
+
+import asyncio
+import numpy
+from encoding_matrix import EncodingMatrix, MatchResult
+from logger import logger
+
+
+class MatchingIndex:
+    """
+    Search strategy over an `EncodingMatrix`. The index doesn't own encodings, it only
+    tracks slots: the owner must call `add` after a slot was filled and `remove` before it is freed.
+    """
+
+    matrix: EncodingMatrix
+
+    def __init__(self, matrix: EncodingMatrix):
+        self.matrix = matrix
+
+    def add(self, slot: int):
+        pass
+
+    def remove(self, slot: int):
+        pass
+
+    def search(self, target) -> MatchResult | None:
+        raise NotImplementedError
+
+    def search_many(self, targets) -> list:
+        return [self.search(target) for target in targets]
+
+
+class ExactIndex(MatchingIndex):
+    """Brute-force scan over every slot."""
+
+    def search(self, target) -> MatchResult | None:
+        return self.matrix.match(target)
+
+    def search_many(self, targets) -> list:
+        return self.matrix.match_many(targets)
+
+
+class IVFIndex(MatchingIndex):
+    """
+    Inverted file index: slots are partitioned into `lists` clusters by k-means centroids and a search
+    scans only the `probes` clusters nearest to the target. Candidates are re-ranked with exact distances.
+
+    With `quantized=True` every slot also keeps an 8-bit scalar-quantized code; probed clusters are scored
+    on the codes first and only the best `rerank` candidates are re-ranked exactly.
+
+    Until the matrix holds `lists * MIN_POINTS_PER_LIST` encodings the index is untrained and falls back
+    to the exact scan. It is retrained when the matrix doubles in size since the last training.
+    Training triggered by `add` in a running event loop runs k-means in the default executor; the old
+    centroids keep serving searches until the new ones are swapped in.
+    """
+
+    MIN_POINTS_PER_LIST = 8
+    TRAINING_POINTS_PER_LIST = 64
+    KMEANS_ITERATIONS = 10
+
+    lists: int
+    probes: int
+    quantized: bool
+    rerank: int
+
+    _centroids: numpy.ndarray | None
+    _list_slots: list    # numpy.ndarray of slots per cluster
+    _list_counts: numpy.ndarray
+    _assignments: numpy.ndarray    # slot -> cluster, -1 if not indexed
+    _positions: numpy.ndarray    # slot -> position inside its cluster list
+    _codes: numpy.ndarray | None
+    _code_min: numpy.ndarray | None
+    _code_scale: numpy.ndarray | None
+    _code_step: numpy.ndarray | None
+    _trained_size: int
+    _training: asyncio.Future | None    # k-means running in the executor
+    _changed_slots: set | None    # slots added or removed while training
+
+    def __init__(self, matrix: EncodingMatrix, lists: int = 256, probes: int = 8, quantized: bool = False, rerank: int = 64, seed: int = 0):
+        super().__init__(matrix)
+        self.lists = max(1, lists)
+        self.probes = max(1, min(probes, self.lists))
+        self.quantized = quantized
+        self.rerank = max(1, rerank)
+        self._random = numpy.random.default_rng(seed)
+
+        self._centroids = None
+        self._list_slots = []
+        self._list_counts = numpy.zeros(0, dtype=numpy.int64)
+        self._assignments = numpy.full(matrix.capacity, -1, dtype=numpy.int64)
+        self._positions = numpy.zeros(matrix.capacity, dtype=numpy.int64)
+        self._codes = None
+        self._code_min = None
+        self._code_scale = None
+        self._code_step = None
+        self._trained_size = 0
+        self._training = None
+        self._changed_slots = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def _ensure_capacity(self):
+        capacity = self.matrix.capacity
+        if len(self._assignments) >= capacity:
+            return
+
+        assignments = numpy.full(capacity, -1, dtype=numpy.int64)
+        assignments[:len(self._assignments)] = self._assignments
+        self._assignments = assignments
+
+        positions = numpy.zeros(capacity, dtype=numpy.int64)
+        positions[:len(self._positions)] = self._positions
+        self._positions = positions
+
+        if self._codes is not None:
+            codes = numpy.zeros((capacity, EncodingMatrix.ENCODING_SIZE), dtype=numpy.uint8)
+            codes[:len(self._codes)] = self._codes
+            self._codes = codes
+
+    def _encode(self, rows: numpy.ndarray) -> numpy.ndarray:
+        return self._quantize(rows, (self._code_min, self._code_scale, self._code_step))
+
+    def _append_to_list(self, cluster: int, slot: int):
+        count = self._list_counts[cluster]
+        slots = self._list_slots[cluster]
+        if count >= len(slots):
+            grown = numpy.empty(max(16, len(slots) * 2), dtype=numpy.int64)
+            grown[:count] = slots[:count]
+            self._list_slots[cluster] = slots = grown
+        slots[count] = slot
+        self._positions[slot] = count
+        self._assignments[slot] = cluster
+        self._list_counts[cluster] = count + 1
+
+    def _nearest_centroids(self, rows: numpy.ndarray, centroids: numpy.ndarray = None) -> numpy.ndarray:
+        if centroids is None:
+            centroids = self._centroids
+        # |r - c|² without the |r|² term, which doesn't change the ordering
+        scores = rows @ centroids.T
+        scores *= -2
+        scores += numpy.einsum("ij,ij->i", centroids, centroids)
+        return numpy.argmin(scores, axis=1)
+
+    def _fit(self, rows: numpy.ndarray) -> tuple:
+        """
+        Runs k-means and fits the quantizer. Reads no index state but the parameters, so it may run in another thread.
+        :return: (centroids, cluster per row, (code min, code scale, code step) or None, codes of the rows or None)
+        """
+        sample_size = min(len(rows), self.lists * self.TRAINING_POINTS_PER_LIST)
+        sample = rows[self._random.choice(len(rows), sample_size, replace=False)]
+
+        centroids = sample[self._random.choice(sample_size, self.lists, replace=False)].copy()
+        for _ in range(self.KMEANS_ITERATIONS):
+            labels = self._nearest_centroids(sample, centroids)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, labels, sample)
+            counts = numpy.bincount(labels, minlength=self.lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, numpy.newaxis]
+            # re-seed empty clusters with random points so every list stays useful
+            empty = numpy.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = sample[self._random.choice(sample_size, len(empty))]
+
+        quantizer = codes = None
+        if self.quantized:
+            code_min = rows.min(axis=0)
+            span = rows.max(axis=0) - code_min
+            code_scale = numpy.where(span > 0, 255 / numpy.maximum(span, 1e-12), 0).astype(numpy.float32)
+            quantizer = (code_min, code_scale, (span / 255).astype(numpy.float32))
+            codes = self._quantize(rows, quantizer)
+        return centroids, self._nearest_centroids(rows, centroids), quantizer, codes
+
+    @staticmethod
+    def _quantize(rows: numpy.ndarray, quantizer: tuple) -> numpy.ndarray:
+        code_min, code_scale, _ = quantizer
+        codes = (rows - code_min) * code_scale
+        numpy.clip(codes, 0, 255, out=codes)
+        return numpy.rint(codes).astype(numpy.uint8)
+
+    def _install(self, slots: numpy.ndarray, centroids: numpy.ndarray, labels: numpy.ndarray,
+                 quantizer: tuple | None, codes: numpy.ndarray | None):
+        """Replaces the centroids, quantizer and cluster lists with the result of `_fit` for `slots`."""
+        self._centroids = centroids
+        self._ensure_capacity()
+        if quantizer is not None:
+            self._code_min, self._code_scale, self._code_step = quantizer
+            self._codes = numpy.zeros((self.matrix.capacity, EncodingMatrix.ENCODING_SIZE), dtype=numpy.uint8)
+            self._codes[slots] = codes
+        else:
+            self._codes = None
+
+        self._list_slots = [numpy.empty(16, dtype=numpy.int64) for _ in range(self.lists)]
+        self._list_counts = numpy.zeros(self.lists, dtype=numpy.int64)
+        self._assignments[:] = -1
+        for slot, cluster in zip(slots, labels):
+            self._append_to_list(int(cluster), int(slot))
+
+        self._trained_size = len(slots)
+        logger.debug(f"Matching index trained: {len(slots)} encodings in {self.lists} lists")
+
+    def train(self):
+        """(Re)builds centroids, quantizer and cluster lists from every stored slot."""
+        slots = self.matrix.occupied_slots()
+        if len(slots) < self.lists:
+            self._centroids = None
+            return
+        self._install(slots, *self._fit(self.matrix.data[slots]))
+
+    def _schedule_training(self):
+        """Trains in the executor if called from a running event loop, right away otherwise."""
+        if self._training is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.train()
+            return
+
+        slots = self.matrix.occupied_slots()
+        if len(slots) < self.lists:
+            return
+        # indexing copies the rows, the matrix may change while k-means runs
+        rows = self.matrix.data[slots]
+        self._changed_slots = set()
+        self._training = loop.run_in_executor(None, self._fit, rows)
+        self._training.add_done_callback(lambda future: self._on_trained(slots, future))
+
+    def _on_trained(self, slots: numpy.ndarray, future: asyncio.Future):
+        changed, self._changed_slots = self._changed_slots, None
+        self._training = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error("Failed to train the matching index", exc_info=future.exception())
+            return
+
+        centroids, labels, quantizer, codes = future.result()
+        if changed:
+            # the slots added or removed meanwhile are assigned with the new centroids if they are still occupied
+            kept = ~numpy.isin(slots, numpy.fromiter(changed, dtype=numpy.int64, count=len(changed)))
+            extra = numpy.array(sorted(slot for slot in changed if self.matrix.key_at(slot) is not None), dtype=numpy.int64)
+            slots, labels = slots[kept], labels[kept]
+            if codes is not None:
+                codes = codes[kept]
+            if len(extra):
+                rows = self.matrix.data[extra]
+                slots = numpy.concatenate([slots, extra])
+                labels = numpy.concatenate([labels, self._nearest_centroids(rows, centroids)])
+                if codes is not None:
+                    codes = numpy.concatenate([codes, self._quantize(rows, quantizer)])
+        self._install(slots, centroids, labels, quantizer, codes)
+
+    def add(self, slot: int):
+        if self._changed_slots is not None:
+            self._changed_slots.add(slot)
+        if not self.is_trained:
+            if len(self.matrix) >= self.lists * self.MIN_POINTS_PER_LIST:
+                self._schedule_training()
+            return
+        if len(self.matrix) >= 2 * self._trained_size:
+            self._schedule_training()
+            if self._training is None:
+                # trained right away, the slot is indexed already
+                return
+
+        self._ensure_capacity()
+        row = self.matrix.row(slot)
+        cluster = int(self._nearest_centroids(row[numpy.newaxis])[0])
+        self._append_to_list(cluster, slot)
+        if self._codes is not None:
+            self._codes[slot] = self._encode(row[numpy.newaxis])[0]
+
+    def remove(self, slot: int):
+        if self._changed_slots is not None:
+            self._changed_slots.add(slot)
+        if not self.is_trained or slot >= len(self._assignments):
+            return
+        cluster = int(self._assignments[slot])
+        if cluster < 0:
+            return
+
+        # swap with the last element of the list
+        position = self._positions[slot]
+        last = self._list_counts[cluster] - 1
+        slots = self._list_slots[cluster]
+        moved = slots[last]
+        slots[position] = moved
+        self._positions[moved] = position
+        self._list_counts[cluster] = last
+        self._assignments[slot] = -1
+
+    def search(self, target) -> MatchResult | None:
+        if not self.is_trained:
+            return self.matrix.match(target)
+
+        target = numpy.asarray(target, dtype=numpy.float32)
+        centroid_distances = numpy.einsum("ij,ij->i", self._centroids, self._centroids) - 2 * (self._centroids @ target)
+        if self.probes < self.lists:
+            probed = numpy.argpartition(centroid_distances, self.probes - 1)[:self.probes]
+        else:
+            probed = numpy.arange(self.lists)
+
+        candidates = numpy.concatenate([self._list_slots[c][:self._list_counts[c]] for c in probed])
+        if len(candidates) == 0:
+            return None
+
+        if self._codes is not None and len(candidates) > self.rerank:
+            query_code = (target - self._code_min) * self._code_scale
+            approx = self._codes[candidates].astype(numpy.float32)
+            approx -= query_code
+            approx *= self._code_step    # back to encoding units, the scale differs per dimension
+            approx = numpy.einsum("ij,ij->i", approx, approx)
+            candidates = candidates[numpy.argpartition(approx, self.rerank - 1)[:self.rerank]]
+
+        return self.matrix.best_of(self.matrix.distances_to_slots(target, candidates), candidates)
+
+
+def create_index(matrix: EncodingMatrix, kind: str, **params) -> MatchingIndex:
+    """
+    :param kind: "exact" or "ivf"
+    :param params: IVFIndex parameters, ignored for the exact index
+    """
+    if kind == "exact":
+        return ExactIndex(matrix)
+    if kind == "ivf":
+        return IVFIndex(matrix, **params)
+    raise ValueError(f"Unknown matching index kind: {kind}")
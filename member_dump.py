@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import codecs
+import json
+import re
+import time
+import numpy
+from logger import logger
+
+
+ENCODING_SIZE = 128
+BYTES_PER_MEMBER = 2600    # about 128 floats of text with the escaping; only sizes the first allocation
+MAX_OUTER_SIZE = 1024 * 1024    # the response fields besides "clients" are small
+
+_CLIENTS_KEY = re.compile(r'"clients"\s*:\s*"')
+_SPACE = re.compile(r"[\s,]*")
+
+
+def _find_unescaped_quote(text: str, start: int = 0) -> int:
+    """
+    :return: index of the first quote from `start` that is preceded by an even number of backslashes, -1 if there is none
+    """
+    position = text.find('"', start)
+    while position != -1:
+        backslashes = 0
+        while position > backslashes and text[position - backslashes - 1] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return position
+        position = text.find('"', position + 1)
+    return -1
+
+
+class MemberDumpParser:
+    """
+    Incremental parser of the initial member dump:
+        {"result": "...", "clients": "[{\\"id\\": 1, \\"fio\\": \\"...\\", \\"encoding\\": \\"[0.1, ...]\\"}, ...]"}
+    The "clients" JSON string is unescaped and parsed while the bytes arrive, one client at a time, and
+    every encoding is written straight into a float32 array. Only the array, the current chunk and one
+    unparsed client are held in memory, never the whole text.
+
+    `feed` the response chunks, then `close` to get the result.
+    """
+
+    encodings: numpy.ndarray    # (capacity, ENCODING_SIZE); rows [0, count) are filled
+    ids: list
+    names: list
+    parse_time: float    # seconds spent in the parser
+    bytes_parsed: int
+
+    _decoder: codecs.IncrementalDecoder
+    _json: json.JSONDecoder
+    _state: str    # "outer" - before the clients string; "clients" - inside it; "suffix" - after it
+    _outer: list    # the text of the response without the clients string
+    _buffer: str    # undecoded tail of the clients string
+    _clients: str    # unescaped text of the clients array not parsed yet
+    _array_started: bool
+
+    def __init__(self, expected_size: int = None):
+        """
+        :param expected_size: response size in bytes if known; used to preallocate the encodings
+        """
+        capacity = max(16, (expected_size or 0) // BYTES_PER_MEMBER + 1)
+        self.encodings = numpy.empty((capacity, ENCODING_SIZE), dtype=numpy.float32)
+        self.ids = []
+        self.names = []
+        self.parse_time = 0
+        self.bytes_parsed = 0
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._state = "outer"
+        self._outer = []
+        self._buffer = ""
+        self._clients = ""
+        self._array_started = False
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def feed(self, chunk: bytes):
+        started = time.perf_counter()
+        self.bytes_parsed += len(chunk)
+        self._feed_text(self._decoder.decode(chunk))
+        self.parse_time += time.perf_counter() - started
+
+    def _feed_text(self, text: str):
+        if self._state == "outer":
+            self._buffer += text
+            match = _CLIENTS_KEY.search(self._buffer)
+            if match is None:
+                if len(self._buffer) > MAX_OUTER_SIZE:
+                    raise ValueError("The member dump has no clients string")
+                return
+            self._outer.append(self._buffer[:match.end() - 1])
+            text = self._buffer[match.end():]
+            self._buffer = ""
+            self._state = "clients"
+
+        if self._state == "clients":
+            self._feed_clients(text)
+        else:
+            self._outer.append(text)
+
+    def _feed_clients(self, text: str):
+        # the carried tail was searched already; it starts after a comma, so no run of backslashes crosses its start
+        searched = len(self._buffer)
+        self._buffer += text
+        end = _find_unescaped_quote(self._buffer, searched)
+        if end != -1:
+            segment = self._buffer[:end]
+            self._state = "suffix"
+            self._outer.append('""' + self._buffer[end + 1:])
+            self._buffer = ""
+        else:
+            # an escape sequence never contains a comma, so the text up to the last comma can be unescaped alone
+            cut = self._buffer.rfind(",") + 1
+            if cut == 0:
+                return
+            segment = self._buffer[:cut]
+            self._buffer = self._buffer[cut:]
+
+        self._clients += json.loads('"' + segment + '"')
+        self._parse_clients()
+
+    def _parse_clients(self):
+        text = self._clients
+        position = 0
+        if not self._array_started:
+            position = _SPACE.match(text, position).end()
+            if position == len(text):
+                return
+            if text[position] != "[":
+                raise ValueError("The clients of the member dump are not an array")
+            self._array_started = True
+            position += 1
+
+        while True:
+            position = _SPACE.match(text, position).end()
+            if position == len(text) or text[position] == "]":
+                break
+            try:
+                client, position = self._json.raw_decode(text, position)
+            except json.JSONDecodeError:
+                # the client isn't complete yet
+                break
+            self._add_client(client)
+        self._clients = text[position:]
+
+    def _add_client(self, client: dict):
+        try:
+            user_id, name, encoding = client["id"], client["fio"], client["encoding"]
+        except (KeyError, TypeError) as ex:
+            logger.error("Failed to parse client data", exc_info=ex)
+            return
+
+        row = self.count
+        if row == len(self.encodings):
+            grown = numpy.empty((len(self.encodings) * 2, ENCODING_SIZE), dtype=numpy.float32)
+            grown[:row] = self.encodings[:row]
+            self.encodings = grown
+
+        try:
+            if isinstance(encoding, str):
+                values = numpy.fromstring(encoding.strip()[1:-1], dtype=numpy.float32, sep=",")
+            else:
+                values = numpy.asarray(encoding, dtype=numpy.float32)
+            if values.shape != (ENCODING_SIZE, ):
+                raise ValueError(f"expected {ENCODING_SIZE} values, got {values.size}")
+        except ValueError as ex:
+            logger.error(f"Failed to parse the encoding of client {user_id}", exc_info=ex)
+            return
+
+        self.encodings[row] = values
+        self.ids.append(user_id)
+        self.names.append(name)
+
+    def close(self) -> dict:
+        """
+        :return: the response object without the clients string
+        """
+        started = time.perf_counter()
+        self._feed_text(self._decoder.decode(b"", final=True))
+        if self._state == "outer":
+            outer = json.loads(self._buffer)
+        elif self._state == "clients":
+            raise ValueError("The member dump ended inside the clients string")
+        else:
+            if self._clients.strip() not in ("", "]"):
+                raise ValueError(f"The member dump has unparsed clients: {self._clients[:100]!r}")
+            outer = json.loads("".join(self._outer))
+
+        # don't keep a mostly empty array alive
+        if self.count < len(self.encodings) * 3 // 4:
+            self.encodings = self.encodings[:self.count].copy()
+        self.parse_time += time.perf_counter() - started
+        return outer
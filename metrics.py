@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable
+from aiohttp import web
+from logger import logger
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    value: float
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name: str, labels: tuple) -> list:
+        return [f"{name}{_format_labels(labels)} {_format_value(self.value)}"]
+
+
+class Gauge:
+    value: float
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labels: tuple) -> list:
+        return [f"{name}{_format_labels(labels)} {_format_value(self.value)}"]
+
+
+class Histogram:
+    buckets: tuple
+    counts: list    # per bucket, not cumulative; the last one is +Inf
+    sum: float
+    count: int
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    async def time_async(self, awaitable: Awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self, name: str, labels: tuple) -> list:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"), ), counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', _format_value(bound)), ))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Metric families by name. A family holds one metric per distinct set of label values:
+        registry.histogram("face_detection_seconds", "...", camera=0).observe(0.02)
+    """
+
+    _families: dict    # name -> (type, help, {labels: metric})
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, name: str, help_text: str, factory, labels: dict):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        family = self._families.get(name)
+        if family is None or key not in family[2]:
+            with self._lock:
+                family = self._families.setdefault(name, (kind, help_text, {}))
+                if family[0] != kind:
+                    raise ValueError(f"Metric {name} is already registered as {family[0]}")
+                family[2].setdefault(key, factory())
+        return family[2][key]
+
+    def counter(self, name: str, help_text: str = "", **labels) -> Counter:
+        return self._get("counter", name, help_text, Counter, labels)
+
+    def gauge(self, name: str, help_text: str = "", **labels) -> Gauge:
+        return self._get("gauge", name, help_text, Gauge, labels)
+
+    def histogram(self, name: str, help_text: str = "", buckets: tuple = DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get("histogram", name, help_text, lambda: Histogram(buckets), labels)
+
+    def render(self) -> str:
+        """Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        with self._lock:
+            families = [(name, kind, help_text, list(metrics.items())) for name, (kind, help_text, metrics) in sorted(self._families.items())]
+        for name, kind, help_text, metrics in families:
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                lines += metric.render(name, labels)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class FrameRateMeter:
+    """Counts frames of a camera and keeps an exponentially smoothed FPS gauge."""
+
+    SMOOTHING = 0.1
+
+    def __init__(self, camera: int):
+        self.frames = registry.counter("camera_frames_total", "Frames read from the camera", camera=camera)
+        self.fps = registry.gauge("camera_fps", "Smoothed frame rate of the camera", camera=camera)
+        self._last = None
+
+    def tick(self):
+        now = time.perf_counter()
+        self.frames.inc()
+        if self._last is not None and now > self._last:
+            fps = 1 / (now - self._last)
+            self.fps.set(fps if self.fps.value == 0 else self.fps.value + (fps - self.fps.value) * self.SMOOTHING)
+        self._last = now
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=registry.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Serves `registry` at http://host:port/metrics on the running event loop."""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import os
+import time
+from dataclasses import dataclass
+import api
+import metrics
+from logger import logger
+
+
+@dataclass
+class OpeningEvent:
+    seq: int
+    user_id: int
+    direction: bool    # False - for entering; True - for exiting
+    time: datetime.datetime
+
+
+class OpeningEventQueue:
+    """
+    Opening events waiting to be sent to the backend, kept in an append-only file so they survive
+    network outages and restarts.
+
+    The file is a JSON line per event and a {"ack": [seq, ...]} line per flushed batch. It is rewritten
+    with only the pending events on start and, in the executor, whenever it is larger than COMPACT_SIZE
+    and the acknowledged lines make up most of it.
+    A background task sends the events in batches over the shared `api.APIClient` session and retries
+    failed ones with exponential backoff; the events keep their original time.
+    """
+
+    COMPACT_SIZE = 64 * 1024
+    MIN_RETRY_INTERVAL = 1
+
+    path: str
+    url: str
+    batch_size: int
+    max_retry_interval: float
+
+    _client: api.APIClient
+    _pending: dict    # seq -> OpeningEvent, in order of seq
+    _next_seq: int
+    _file: [object, None]
+    _unsynced: bool
+    _pending_size: int    # bytes of the lines of the pending events
+    _wake: asyncio.Event
+    _task: [asyncio.Task, None]
+
+    def __init__(self, path: str, client: api.APIClient, url: str, batch_size: int = 20, max_retry_interval: float = 300):
+        """
+        :param path: queue file
+        :param url: the opening event endpoint
+        :param batch_size: events sent per flush
+        :param max_retry_interval: seconds, the backoff limit
+        """
+        self.path = path
+        self.url = url
+        self.batch_size = batch_size
+        self.max_retry_interval = max_retry_interval
+        self._client = client
+        self._pending = {}
+        self._next_seq = 0
+        self._file = None
+        self._unsynced = False
+        self._pending_size = 0
+        self._wake = asyncio.Event()
+        self._task = None
+
+        self.depth = metrics.registry.gauge("opening_queue_depth", "Opening events waiting to be sent")
+        self.flush_time = metrics.registry.histogram("opening_queue_flush_seconds", "Time to send a batch of opening events")
+        self.sent = metrics.registry.counter("opening_events_sent_total", "Opening events delivered to the backend")
+        self.failures = metrics.registry.counter("opening_events_failed_total", "Failed attempts to send an opening event")
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _load(self):
+        self._pending = {}
+        last_seq = -1
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        if "ack" in record:
+                            for seq in record["ack"]:
+                                self._pending.pop(seq, None)
+                            continue
+                        event = OpeningEvent(record["seq"], record["user_id"], record["direction"],
+                                             datetime.datetime.fromisoformat(record["time"]))
+                    except (ValueError, KeyError, TypeError):
+                        # a line torn by a power loss
+                        logger.warning(f"Skipping a broken line of the opening queue: {line!r}")
+                        continue
+                    self._pending[event.seq] = event
+                    last_seq = max(last_seq, event.seq)
+        self._next_seq = last_seq + 1
+        self._compact()
+
+    def _compact(self):
+        """Rewrites the file with only the pending events."""
+        if self._file is not None:
+            self._file.close()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        self._write_events(temp_path, list(self._pending.values()))
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._unsynced = False
+        self._pending_size = self._file.tell()
+        self.depth.set(len(self._pending))
+
+    def _should_compact(self) -> bool:
+        size = self._file.tell()
+        return size > self.COMPACT_SIZE and self._pending_size * 2 < size
+
+    def _write_events(self, path: str, events: list):
+        with open(path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(self._format(event))
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _compact_in_background(self):
+        """Like `_compact`, but the events are written and synced in the executor while new ones are still put."""
+        events = list(self._pending.values())
+        temp_path = self.path + ".tmp"
+        await asyncio.get_running_loop().run_in_executor(None, self._write_events, temp_path, events)
+
+        # the events put meanwhile were written to the old file only
+        written = {event.seq for event in events}
+        compacted = open(temp_path, "a", encoding="utf-8")
+        for seq, event in self._pending.items():
+            if seq not in written:
+                compacted.write(self._format(event))
+        acked = [seq for seq in written if seq not in self._pending]
+        if acked:
+            compacted.write(json.dumps({"ack": acked}) + "\n")
+        compacted.flush()
+        os.replace(temp_path, self.path)
+        self._file.close()
+        self._file = compacted
+        # the lines appended here are synced by the sender like any other write
+        self._unsynced = True
+        logger.debug(f"Compacted the opening queue: {len(self._pending)} pending events")
+
+    @staticmethod
+    def _format(event: OpeningEvent) -> str:
+        return json.dumps({"seq": event.seq, "user_id": event.user_id, "direction": event.direction,
+                           "time": event.time.isoformat()}) + "\n"
+
+    def _write(self, line: str):
+        self._file.write(line)
+        self._file.flush()
+        # fsync is left to the sender, it would delay the lock
+        self._unsynced = True
+
+    def _sync(self):
+        if self._unsynced and self._file is not None:
+            self._unsynced = False
+            os.fsync(self._file.fileno())
+
+    def put(self, user_id: int, direction: bool, event_time: datetime.datetime = None):
+        """
+        Queues an opening event. Must be called from the event loop.
+        :param event_time: defaults to the current time
+        """
+        if self._file is None:
+            self._load()
+        event = OpeningEvent(self._next_seq, user_id, direction, event_time or datetime.datetime.now())
+        self._next_seq += 1
+        line = self._format(event)
+        self._write(line)
+        self._pending[event.seq] = event
+        self._pending_size += len(line)
+        self.depth.set(len(self._pending))
+        self._wake.set()
+
+    async def _ack(self, seqs: list):
+        if not seqs:
+            return
+        for seq in seqs:
+            event = self._pending.pop(seq, None)
+            if event is not None:
+                self._pending_size -= len(self._format(event))
+        self._write(json.dumps({"ack": seqs}) + "\n")
+        self.depth.set(len(self._pending))
+        if self._should_compact():
+            await self._compact_in_background()
+
+    def start(self):
+        if self._file is None:
+            self._load()
+        if self._pending:
+            logger.info(f"{len(self._pending)} opening events are waiting to be sent")
+            self._wake.set()
+        self._task = asyncio.create_task(self._sender())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    async def _send(self, event: OpeningEvent) -> bool:
+        """
+        :return: True if the event is done with: delivered or rejected by the backend for good
+        """
+        try:
+            await self._client.send_opening(self.url, event.user_id, event.direction, event.time)
+            self.sent.inc()
+            return True
+        except api.APIError as ex:
+            self.failures.inc()
+            if 400 <= ex.response_code < 500 and ex.response_code not in (408, 429):
+                logger.error(f"The backend rejected the opening event of user {event.user_id} at {event.time}, dropping it. "
+                             f"Status code: {ex.response_code}\nResponse text: {ex.reponse_text}")
+                return True
+            logger.warning(f"Failed to send the opening event of user {event.user_id}: status code {ex.response_code}")
+        except Exception as ex:
+            self.failures.inc()
+            logger.warning(f"Failed to send the opening event of user {event.user_id}: {ex!r}")
+        return False
+
+    async def _sender(self):
+        loop = asyncio.get_running_loop()
+        retry_interval = 0
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+
+            await loop.run_in_executor(None, self._sync)
+
+            batch = list(self._pending.values())[:self.batch_size]
+            started = time.perf_counter()
+            done = await asyncio.gather(*[self._send(event) for event in batch])
+            self.flush_time.observe(time.perf_counter() - started)
+            await self._ack([event.seq for event, is_done in zip(batch, done) if is_done])
+
+            if all(done):
+                retry_interval = 0
+                continue
+
+            retry_interval = min(self.max_retry_interval, max(self.MIN_RETRY_INTERVAL, retry_interval * 2))
+            logger.info(f"Retrying {len(self._pending)} opening events in {retry_interval} s")
+            await asyncio.sleep(retry_interval)
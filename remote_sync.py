@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+
+@dataclass
+class SyncPosition:
+    """
+    Where the incremental sync stopped. Saved with the snapshot of the remote users, so a restart
+    continues from the same place instead of missing the changes made meanwhile.
+    """
+
+    cursor: str | None = None    # opaque position in the backend's change log; None - the backend doesn't send one
+    etag: str | None = None    # validator of the last update response, sent back as If-None-Match
+    synced_at: float = 0    # time.time() of the last successful poll
+
+    def to_meta(self) -> dict:
+        return {"synced_at": self.synced_at, "cursor": self.cursor, "etag": self.etag}
+
+    @classmethod
+    def from_meta(cls, meta: dict) -> SyncPosition:
+        cursor, etag = meta.get("cursor"), meta.get("etag")
+        return cls(str(cursor) if cursor is not None else None, str(etag) if etag is not None else None,
+                   float(meta.get("synced_at", 0)))
+
+
+class PollInterval:
+    """
+    Delay before the next poll for updates: the minimum right after a poll brought changes,
+    growing by `factor` with every idle or failed poll up to the maximum.
+    """
+
+    minimum: float
+    maximum: float
+    factor: float
+    current: float
+
+    def __init__(self, minimum: float, maximum: float, factor: float = 2):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.current = minimum
+
+    def changed(self) -> float:
+        self.current = self.minimum
+        return self.current
+
+    def idle(self) -> float:
+        self.current = min(self.maximum, max(self.minimum, self.current * self.factor))
+        return self.current
@@ -11,12 +11,20 @@ GPIO.setup(OUTPUT_PIN, GPIO.OUT, initial=GPIO.LOW)
 #GPIO.output(OUTPUT_PIN, GPIO.LOW)
 GPIO.setup(CAMERA_PIN, GPIO.OUT, initial=GPIO.HIGH)
 
+_holders = 0    # the entrance and the exit may open the lock at the same time; it closes when the last one ends
+
 async def open_for_seconds(seconds: int):
+	global _holders
+	_holders += 1
 	GPIO.output(OUTPUT_PIN, GPIO.HIGH)
 	print("OPEN LOCK")
-	await asyncio.sleep(seconds)
-	print("CLOSE LOCK")
-	GPIO.output(OUTPUT_PIN, GPIO.LOW)
+	try:
+		await asyncio.sleep(seconds)
+	finally:
+		_holders -= 1
+		if _holders == 0:
+			print("CLOSE LOCK")
+			GPIO.output(OUTPUT_PIN, GPIO.LOW)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+import numpy
+from logger import logger
+
+
+ENCODING_SIZE = 128
+NAME_SIZE = 128    # bytes of UTF-8, longer names are truncated
+
+FLAG_DELETED = 1
+
+INDEX_DTYPE = numpy.dtype([("id", "<i8"), ("flags", "u1"), ("name", f"S{NAME_SIZE}")])
+ENCODING_DTYPE = numpy.dtype("<f4")
+
+
+@dataclass
+class StoredUser:
+    row: int
+    user_id: int
+    name: str
+    encoding: numpy.ndarray    # copied out of the mapped file, so the files can be replaced while it is in use
+
+
+class EncodedUserStore:
+    """
+    Encoded users in two append-only binary files:
+        <name>.encodings - float32 encodings, ENCODING_SIZE per row;
+        <name>.index - fixed size (id, flags, name) records, one per row.
+
+    Both are memory-mapped on load, so loading doesn't parse anything; the live rows are copied out and
+    the maps are closed at once, as Windows can't replace a mapped file. New users are appended;
+    a deleted user is only flagged in its index record. The files are compacted on load once
+    most rows are deleted. A row is valid once its index record is written, so an interrupted
+    append is cut off on the next open.
+    """
+
+    COMPACT_RATIO = .5    # compact on load if more than this part of the rows is deleted
+
+    encodings_path: str
+    index_path: str
+
+    _rows: dict    # user ID -> row of the live record
+
+    def __init__(self, directory: str, name: str = "encoded_users"):
+        self.encodings_path = os.path.join(directory, f"{name}.encodings")
+        self.index_path = os.path.join(directory, f"{name}.index")
+        self.meta_path = os.path.join(directory, f"{name}.meta.json")
+        self._rows = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, user_id: int):
+        return user_id in self._rows
+
+    def read_meta(self) -> dict | None:
+        """
+        :return: the metadata saved with `write_meta`, None if there is none
+        """
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            logger.warning(f"Ignoring the invalid metadata file '{self.meta_path}'", exc_info=ex)
+            return None
+
+    def write_meta(self, meta: dict | None):
+        """
+        Atomically replaces the metadata saved next to the store. None removes it.
+        """
+        if meta is None:
+            if os.path.exists(self.meta_path):
+                os.remove(self.meta_path)
+            return
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def _repair(self) -> int:
+        """
+        Cuts off an incomplete trailing record of either file.
+        :return: number of complete rows
+        """
+        for path in (self.index_path, self.encodings_path):
+            if not os.path.exists(path):
+                open(path, "ab").close()
+
+        rows = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        rows = min(rows, os.path.getsize(self.encodings_path) // (ENCODING_DTYPE.itemsize * ENCODING_SIZE))
+        for path, size in ((self.index_path, rows * INDEX_DTYPE.itemsize),
+                           (self.encodings_path, rows * ENCODING_DTYPE.itemsize * ENCODING_SIZE)):
+            if os.path.getsize(path) != size:
+                logger.warning(f"Cutting off an incomplete record of '{path}'")
+                os.truncate(path, size)
+        return rows
+
+    def _map(self, rows: int) -> tuple:
+        if rows == 0:
+            return numpy.empty(0, dtype=INDEX_DTYPE), numpy.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        index = numpy.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r", shape=(rows, ))
+        encodings = numpy.memmap(self.encodings_path, dtype=ENCODING_DTYPE, mode="r", shape=(rows, ENCODING_SIZE))
+        return index, encodings
+
+    def load(self) -> list:
+        """
+        :return: `StoredUser` per live row
+        """
+        rows = self._repair()
+        index, encodings = self._map(rows)
+
+        live = numpy.flatnonzero((index["flags"] & FLAG_DELETED) == 0)
+        if rows and len(live) < rows * (1 - self.COMPACT_RATIO):
+            del index, encodings
+            self.compact()
+            return self.load()
+
+        # copied, so nothing refers to the maps afterwards
+        index, encodings = numpy.array(index[live]), numpy.array(encodings[live])
+        self._rows = {}
+        users = []
+        for i, row in enumerate(live):
+            user_id = int(index["id"][i])
+            self._rows[user_id] = int(row)
+            users.append(StoredUser(int(row), user_id, index["name"][i].decode("utf-8", errors="ignore"), encodings[i]))
+        return users
+
+    def append(self, user_id: int, name: str, encoding) -> int:
+        """
+        :return: the row of the user
+        """
+        if user_id in self._rows:
+            raise KeyError(f"User {user_id} is already stored")
+        encoding = numpy.asarray(encoding, dtype=ENCODING_DTYPE)
+        if encoding.shape != (ENCODING_SIZE, ):
+            raise ValueError(f"Encoding must have {ENCODING_SIZE} values, got shape {encoding.shape}")
+
+        record = numpy.zeros(1, dtype=INDEX_DTYPE)
+        record["id"] = user_id
+        record["name"] = name.encode("utf-8")[:NAME_SIZE]
+
+        row = self._repair()
+        # the encoding goes first: the row exists only once its index record is complete
+        with open(self.encodings_path, "ab") as f:
+            f.write(encoding.tobytes())
+        with open(self.index_path, "ab") as f:
+            f.write(record.tobytes())
+
+        self._rows[user_id] = row
+        return row
+
+    def delete(self, user_id: int):
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            raise KeyError(f"User {user_id} is not stored")
+
+        index = numpy.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r+", offset=row * INDEX_DTYPE.itemsize, shape=(1, ))
+        index["flags"][0] |= FLAG_DELETED
+        index.flush()
+        del index
+
+    def replace(self, users: list):
+        """
+        Rewrites the store with the users at once.
+        :param users: (user ID, name, encoding) tuples
+        """
+        index = numpy.zeros(len(users), dtype=INDEX_DTYPE)
+        encodings = numpy.empty((len(users), ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        rows = {}
+        for row, (user_id, name, encoding) in enumerate(users):
+            index[row] = (user_id, 0, name.encode("utf-8")[:NAME_SIZE])
+            encodings[row] = encoding
+            rows[user_id] = row
+
+        for path, data in ((self.encodings_path, encodings), (self.index_path, index)):
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data.tobytes())
+            os.replace(temp_path, path)
+        self._rows = rows
+
+    def compact(self):
+        """Rewrites the files without the deleted rows."""
+        rows = self._repair()
+        index, encodings = self._map(rows)
+        live = numpy.flatnonzero((index["flags"] & FLAG_DELETED) == 0)
+        live_index, live_encodings = numpy.array(index[live]), numpy.array(encodings[live])
+        # the files can't be replaced while they are mapped on Windows
+        del index, encodings
+
+        for path, data in ((self.encodings_path, live_encodings), (self.index_path, live_index)):
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(numpy.ascontiguousarray(data).tobytes())
+            os.replace(temp_path, path)
+        logger.info(f"Compacted '{self.index_path}': {rows - len(live)} deleted rows removed")
+
+    def migrate_json(self, json_path: str) -> int:
+        """
+        Appends the users of an encoded_users.json file and renames the file to *.migrated.
+        :return: number of migrated users
+        """
+        with open(json_path, "r", encoding="utf-8") as f:
+            encoded_users = json.load(f)
+
+        # rows of an interrupted migration are already stored
+        self.load()
+        migrated = 0
+        for encoded_user in encoded_users:
+            if encoded_user.get("id") in self._rows:
+                continue
+            try:
+                self.append(encoded_user["id"], encoded_user["name"], encoded_user["encoding"])
+                migrated += 1
+            except Exception as ex:
+                logger.error(f"Failed to migrate local user. Data: {encoded_user}", exc_info=ex)
+
+        os.replace(json_path, json_path + ".migrated")
+        logger.info(f"Migrated {migrated} local users from '{json_path}'")
+        return migrated
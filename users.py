@@ -1,14 +1,16 @@
 import os
-import glob
 import numpy
 import datetime
+import time
 import asyncio
 import api
 from logger import logger
 from typing import Union, Any
-import json
-import aiofiles
-import cv2
+from encoding_matrix import EncodingMatrix, MatchResult
+import matching_index
+from user_store import EncodedUserStore
+import enrollment
+import remote_sync
 
 debug = os.name != "posix"
 if debug:
@@ -23,17 +25,25 @@ class User:
 
     user_id: int
     name: str
-    encoding: list
+    encoding: numpy.ndarray
     is_active: bool
     is_local: bool
+    api_client: api.APIClient
+    opening_queue: Any    # opening_queue.OpeningEventQueue or None
 
     pre_lock_counter: int
     last_opening: Union[datetime.datetime, None]
 
-    def __init__(self, user_id: int, name: str, encoding: Union[numpy.ndarray, list], is_active: bool = True, is_local: bool = False):
+    def __init__(self, user_id: int, name: str, encoding: Union[numpy.ndarray, list], is_active: bool = True, is_local: bool = False,
+                 api_client: api.APIClient = None, opening_queue: Any = None):
+        """
+        :param opening_queue: queue to send the opening events through. None - send them directly with `api_client`
+        """
         self.user_id = user_id
+        self.api_client = api_client or api.get_default_client()
+        self.opening_queue = opening_queue
         self.name = name
-        self.encoding = list(encoding)
+        self.encoding = numpy.asarray(encoding, dtype=numpy.float32)
         self.is_active = is_active
         self.is_local = is_local
 
@@ -56,7 +66,10 @@ class User:
         """
         # send notification to the server
         if not self.is_local:
-            asyncio.ensure_future(api.send_opening(cfg.OPENING_EVENT_URL, self.user_id, direction))
+            if self.opening_queue is not None:
+                self.opening_queue.put(self.user_id, direction)
+            else:
+                asyncio.ensure_future(self.api_client.send_opening(cfg.OPENING_EVENT_URL, self.user_id, direction))
 
         logger.info(f"User {self} {'left' if direction else 'entered'}")
 
@@ -78,41 +91,123 @@ class User:
 class UserManager:
 
     LOAD_REMOTE_USERS_RETRY_INTERVAL = 5
-    SYNC_INTERVAL_SECONDS = 30
+    ENROLLMENT_IMAGES_PER_WORKER = 2    # images decoded ahead so the encoding workers don't wait
+    SYNC_POSITION_SAVE_INTERVAL = 600    # seconds; an unchanged sync position is saved only this often
 
     local_path: str
     local_users: list
     remote_address_update: str
     remote_address_init: str
     remote_users: list
+    encodings: EncodingMatrix    # keys are User objects
+    index: matching_index.MatchingIndex
 
     remote_users_loaded_event: asyncio.Event
+    user_listeners: list    # callables (event, user) notified on "add", "remove" and "update"
 
     recognizer: Any
-
-    def __init__(self, path: str, remote_address_init: str, remote_address_update: str, recognizer: Any = None):
+    encoding_service: Any
+    api_client: api.APIClient
+    opening_queue: Any
+    local_store: Union[EncodedUserStore, None]
+    enrollment_cache: Union[enrollment.EncodingCache, None]
+    remote_store: Union[EncodedUserStore, None]    # snapshot of the remote users with the sync position
+    sync_position: remote_sync.SyncPosition
+
+    _users_by_id: dict    # is_local -> {user ID: User}
+
+    def __init__(self, path: str, remote_address_init: str, remote_address_update: str, recognizer: Any = None, encoding_service: Any = None,
+                 snapshot_path: str = None, api_client: api.APIClient = None, opening_queue: Any = None):
+        """
+        :param snapshot_path: directory to keep the snapshot of the remote users in. None - always download them at start.
+        :param api_client: client shared with the users for their opening events. None - `api.get_default_client()`
+        :param opening_queue: `opening_queue.OpeningEventQueue` the users put their opening events to
+        """
         self.local_path = path
         self.remote_address_init = remote_address_init
         self.remote_address_update = remote_address_update
         self.logger = logger
         self.recognizer = recognizer
+        self.encoding_service = encoding_service
+        self.api_client = api_client or api.get_default_client()
+        self.opening_queue = opening_queue
         self.remote_users_loaded_event = asyncio.Event()
+        self.user_listeners = []
 
         self.local_users = []
         self.remote_users = []
+        self._users_by_id = {True: {}, False: {}}
+        self.encodings = EncodingMatrix()
+        self.index = matching_index.create_index(self.encodings, cfg.MATCHING_INDEX, **cfg.MATCHING_INDEX_PARAMS)
 
         if self.local_path and not os.path.isdir(self.local_path):
             raise NotADirectoryError
+        self.local_store = EncodedUserStore(self.local_path) if self.local_path else None
+        self.enrollment_cache = enrollment.EncodingCache(self.local_path) if self.local_path else None
+
+        self.sync_position = remote_sync.SyncPosition()
+        self.remote_store = None
+        if snapshot_path:
+            os.makedirs(snapshot_path, exist_ok=True)
+            self.remote_store = EncodedUserStore(snapshot_path, "remote_users")
 
-    async def load_remote_users(self):
-        self.remote_users_loaded_event.clear()
+    async def load_remote_snapshot(self) -> Union[float, None]:
+        """
+        Adds the remote users saved by the last sync.
+        :return: age of the snapshot in seconds, None if there is no snapshot
+        """
+        if self.remote_store is None:
+            return None
+        meta = self.remote_store.read_meta()
+        # the metadata is written after the users, a snapshot without it is incomplete
+        if meta is None or not self.remote_store.exists():
+            return None
+
+        self.sync_position = remote_sync.SyncPosition.from_meta(meta)
+        stored_users = self.remote_store.load()
+        for stored_user in stored_users:
+            try:
+                await self.add_user(stored_user.user_id, stored_user.name, False, encoding=stored_user.encoding)
+            except Exception as ex:
+                logger.error(f"Failed to load remote user {stored_user.user_id} from the snapshot", exc_info=ex)
 
-        remote_users = []
+        age = max(0.0, time.time() - self.sync_position.synced_at)
+        logger.info(f"Loaded {len(stored_users)} remote users from the snapshot synced {age / 60:.0f} minutes ago")
+        return age
+
+    def save_sync_position(self):
+        self.sync_position.synced_at = time.time()
+        if self.remote_store is not None:
+            self.remote_store.write_meta(self.sync_position.to_meta())
+
+    @staticmethod
+    def _is_same_user(user: User, name: str, encoding: Union[numpy.ndarray, list]) -> bool:
+        return user.name == name and numpy.array_equal(numpy.asarray(user.encoding, dtype=numpy.float32),
+                                                       numpy.asarray(encoding, dtype=numpy.float32))
+
+    async def load_remote_users(self, snapshot_age: Union[float, None] = ...):
+        """
+        Loads the remote users from the snapshot, if there is a fresh one with a sync cursor, and from the remote server otherwise.
+        The users of an outdated snapshot or of one without a cursor can enter while the full list is downloaded and reconciled.
+        :param snapshot_age: the result of `load_remote_snapshot` if it has been called already; None - download the full list
+        """
+        age = await self.load_remote_snapshot() if snapshot_age is ... else snapshot_age
+        if age is not None:
+            self.remote_users_loaded_event.set()
+            if age > cfg.REMOTE_SNAPSHOT_MAX_AGE:
+                logger.info("The snapshot of the remote users is outdated, downloading the full list")
+            elif self.sync_position.cursor is None:
+                # without a cursor the updates can't bring the changes made while the unit was offline
+                logger.info("The backend doesn't support cursors, reconciling the snapshot with the full list")
+            else:
+                return
+
+        dump = None
 
         while True:
             logger.debug(f"Requesting initial database state from the remote server: '{self.remote_address_init}'")
             try:
-                remote_users = await api.request_users(self.remote_address_init)
+                dump = await self.api_client.request_user_dump(self.remote_address_init)
                 break
             except api.APIError as ex:
                 logger.error(
@@ -127,72 +222,101 @@ class UserManager:
             logger.info("Retrying loading remote users...")
             continue
 
-        logger.debug(f"Received {len(remote_users)} users from the remote server. Adding...")
+        logger.debug(f"Received {len(dump.users)} users from the remote server. Adding...")
+        received_ids = set()
         added = 0
-        for user in remote_users:
+        for user in dump.users:
+            received_ids.add(user.user_id)
+            existing = self._users_by_id[False].get(user.user_id)
             try:
+                if existing is not None:
+                    # the user is known from the snapshot
+                    if self._is_same_user(existing, user.name, user.encoding):
+                        continue
+                    self.remove_user(user.user_id, False)
                 await self.add_user(user.user_id, user.name, False, encoding=user.encoding)
                 added += 1
             except Exception as ex:
                 logger.error(f"Failed to add remote user {user.user_id}", exc_info=ex)
+        for user in [u for u in self.remote_users if u.user_id not in received_ids]:
+            self.remove_user(user.user_id, False)
         logger.info(f"Successfully added {added} users from remote server")
 
+        if self.remote_store is not None:
+            self.remote_store.write_meta(None)
+            self.remote_store.replace([(u.user_id, u.name, u.encoding) for u in self.remote_users])
+        # the updates continue from the position the dump was taken at
+        self.sync_position = remote_sync.SyncPosition(dump.cursor)
+        self.save_sync_position()
+
         self.remote_users_loaded_event.set()
 
 
-    async def load_local_users(self):
+    async def load_local_users(self, enroll: bool = True):
+        """
+        :param enroll: also enroll the new images of the faces directory, see `enroll_local_images`
+        """
         encoded_users_path = os.path.join(self.local_path, "encoded_users.json")
         if os.path.exists(encoded_users_path):
-            logger.info(f"Loading encoded local users from '{encoded_users_path}'")
-            async with aiofiles.open(encoded_users_path, mode='r', encoding='utf-8') as file:
-                encoded_local_users = json.loads(await file.read())
-                logger.debug(f"Read {len(encoded_local_users)} users from the file. Loading...")
-                for encoded_user in encoded_local_users:
-                    try:
-                        await self.add_user(encoded_user["id"], encoded_user["name"], True, encoding=encoded_user["encoding"])
-                    except Exception as ex:
-                        logger.error(f"Failed to load local user. Data: {encoded_user}", exc_info=ex)
-        else:
-            logger.info(f"Encoded local users weren't found. Path: {encoded_users_path}")
-
-        if self.recognizer is not None:
-            logger.debug(f"Searching for new local users in {self.local_path}...")
-            old_path = os.getcwd()
-            os.chdir(self.local_path)
-            new_user_files = glob.glob("*.png") + glob.glob("*.jpg")
-            logger.info(f"Found new user images to load: {new_user_files}")
-            added = 0
-            for path in new_user_files:
-                try:
-                    name = path[:len(path)-4]    # remove extension
-                    user_id = self.find_available_local_id()
-                except Exception as ex:
-                    logger.error(f"Failed to load user from image file {path} because of wrong name", exc_info=ex)
-                    continue
-
-                image = await asyncio.get_event_loop().run_in_executor(None, cv2.imread, path)
-                if image is None:
-                    logger.error(f"Failed to load image file {path}: file not found or not supported")
-                    continue
+            logger.info(f"Migrating encoded local users from '{encoded_users_path}' to '{self.local_store.index_path}'")
+            await asyncio.get_running_loop().run_in_executor(None, self.local_store.migrate_json, encoded_users_path)
 
+        if self.local_store.exists():
+            stored_users = self.local_store.load()
+            logger.debug(f"Read {len(stored_users)} users from '{self.local_store.index_path}'. Loading...")
+            for stored_user in stored_users:
                 try:
-                    await self.add_user(user_id, name, True, image=image)
-                    os.remove(path)
-                    added += 1
+                    await self.add_user(stored_user.user_id, stored_user.name, True, encoding=stored_user.encoding)
                 except Exception as ex:
-                    logger.error(f"Failed to add user {name} with ID {user_id} from image {path}", exc_info=ex)
-                    continue
-            os.chdir(old_path)
-            logger.info(f"Successfully added {added} local users from files")
+                    logger.error(f"Failed to load local user {stored_user.user_id} from row {stored_user.row}", exc_info=ex)
+        else:
+            logger.info(f"Encoded local users weren't found. Path: {self.local_store.index_path}")
+
+        if not enroll:
+            return
+        if self.recognizer is not None or self.encoding_service is not None:
+            await self.enroll_local_images()
         else:
             logger.warning("New local users won't be added because recognizer is not specified")
 
-        async with aiofiles.open(encoded_users_path, mode='w', encoding='utf-8') as f:
-            json_str = json.dumps([{"id": u.user_id, "name": u.name, "encoding": u.encoding} for u in self.local_users])
-            await f.write(json_str)
+    async def _encode_image(self, image: numpy.ndarray) -> numpy.ndarray:
+        if self.encoding_service is not None:
+            return await self.encoding_service.encode(image)
+        return await asyncio.get_running_loop().run_in_executor(None, self.recognizer.get_face_encoding, image)
+
+    async def enroll_local_images(self) -> int:
+        """
+        Adds a local user for every image in the local directory, named after the file, and removes the image.
+        The images are encoded in parallel; encodings of already seen image contents are taken from the cache.
+        :return: number of added users
+        """
+        logger.debug(f"Searching for new local users in {self.local_path}...")
+        paths = enrollment.list_images(self.local_path)
+        if not paths:
+            return 0
+        logger.info(f"Found {len(paths)} new user images to load")
+
+        workers = self.encoding_service.workers if self.encoding_service is not None else 1
+        added = 0
+        async for path, encoding in enrollment.encode_images(paths, self._encode_image, self.enrollment_cache,
+                                                             workers * self.ENROLLMENT_IMAGES_PER_WORKER, enrollment.ProgressLogger()):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if isinstance(encoding, Exception):
+                logger.error(f"Failed to add user {name} from image {path}", exc_info=encoding)
+                continue
+
+            try:
+                user = await self.add_user(self.find_available_local_id(), name, True, encoding=encoding)
+                self.local_store.append(user.user_id, user.name, user.encoding)
+                os.remove(path)
+                added += 1
+            except Exception as ex:
+                logger.error(f"Failed to add user {name} from image {path}", exc_info=ex)
+        logger.info(f"Successfully added {added} local users from files")
+        return added
 
     def find_available_local_id(self) -> int:
-        reserved_ids = [u.user_id for u in self.local_users]
+        reserved_ids = self._users_by_id[True]
         result = 0
         while result in reserved_ids:
             result += 1
@@ -202,14 +326,27 @@ class UserManager:
         asyncio.create_task(self.synchronization_coroutine())
 
     async def synchronization_coroutine(self):
+        """
+        Polls the remote server for the changes after the saved sync position. Polls come every SYNC_MIN_INTERVAL
+        seconds while there are changes and back off to SYNC_MAX_INTERVAL while there are none. With SYNC_LONG_POLL
+        the server holds a poll until a change appears, so the next poll is sent right away.
+        If the server doesn't know the cursor any more, the full list is loaded again.
+        """
+        interval = remote_sync.PollInterval(cfg.SYNC_MIN_INTERVAL, cfg.SYNC_MAX_INTERVAL)
+        long_poll = cfg.SYNC_LONG_POLL
+        # the first poll brings a loaded snapshot up to date right away
+        delay = 0
         while True:
-            await asyncio.sleep(UserManager.SYNC_INTERVAL_SECONDS)
+            await asyncio.sleep(delay)
+            delay = interval.idle()
 
             await self.remote_users_loaded_event.wait()
 
-            logger.debug(f"Requesting updates from remote server: '{self.remote_address_update}'")
+            position = self.sync_position
+            logger.debug(f"Requesting updates from remote server: '{self.remote_address_update}', cursor: {position.cursor}")
+            started = time.monotonic()
             try:
-                updates = await api.request_updates(self.remote_address_update)
+                batch = await self.api_client.request_changes(self.remote_address_update, position.cursor, position.etag, long_poll)
             except api.APIError as ex:
                 logger.error(f"An API error occured during requesting remote updates.\nStatus code: {ex.response_code}\nResponse text: {ex.reponse_text}", exc_info=ex)
                 continue
@@ -220,8 +357,27 @@ class UserManager:
                 logger.critical("An unexpected error occured during requesting remote updates.", exc_info=ex)
                 continue
 
-            log_level_func = logger.info if len(updates) > 0 else logger.debug
-            log_level_func(f"Received {len(updates)} updates from the remote server. Applying...")
+            if batch.reset:
+                logger.warning(f"The remote server doesn't know the sync cursor {position.cursor}, reloading the remote users")
+                await self.load_remote_users(None)
+                delay = interval.changed()
+                continue
+
+            updates = batch.changes
+            if updates:
+                delay = 0 if long_poll else interval.changed()
+            elif long_poll and time.monotonic() - started >= long_poll / 2:
+                # the server held the poll; answering at once would mean it doesn't support long polling
+                delay = 0
+
+            moved = (batch.cursor, batch.etag) != (position.cursor, position.etag)
+            position.cursor, position.etag = batch.cursor, batch.etag
+            if batch.not_modified or not updates:
+                if moved or time.time() - position.synced_at > UserManager.SYNC_POSITION_SAVE_INTERVAL:
+                    self.save_sync_position()
+                continue
+
+            logger.info(f"Received {len(updates)} updates from the remote server. Applying...")
 
             applied = 0
             for update in updates:
@@ -235,27 +391,41 @@ class UserManager:
 
                 if not update.is_valid:
                     logger.error("Skipping invalid remote update", exc_info=update.error)
-            log_level_func(f"Successfully applied {applied} valid updates")
+            logger.info(f"Successfully applied {applied} valid updates")
+            # saved after applying: the changes of an interrupted batch are received again, and applying them is idempotent
+            self.save_sync_position()
 
     async def apply_remote_update(self, change: api.RemoteChange):
         if True:
             if change.action == "add":
                 if change.user_data is None:
                     raise ValueError("User data cannot be None")
-                await self.add_user(change.related_user_id, change.user_data.name, encoding=change.user_data.encoding)
+                existing = self._users_by_id[False].get(change.related_user_id)
+                if existing is not None:
+                    if self._is_same_user(existing, change.user_data.name, change.user_data.encoding):
+                        return
+                    self.remove_user(existing.user_id, False)
+                user = await self.add_user(change.related_user_id, change.user_data.name, encoding=change.user_data.encoding)
+                if self.remote_store is not None:
+                    self.remote_store.append(user.user_id, user.name, user.encoding)
             elif change.action == "delete":
+                if change.related_user_id not in self._users_by_id[False]:
+                    logger.debug(f"Remote user {change.related_user_id} is already deleted")
+                    return
                 self.remove_user(change.related_user_id, False)
             else:
                 raise NotImplementedError(f"Change action {change.action} is not implemented")
 
-    async def add_user(self, user_id: int, name: str, is_local: bool = False, *args, encoding: list = None, image: numpy.ndarray = None):
+    async def add_user(self, user_id: int, name: str, is_local: bool = False, *args, encoding: list = None, image: numpy.ndarray = None) -> User:
         users = self.local_users if is_local else self.remote_users
-        search = [u for u in users if u.user_id == user_id]
-        if search:
-            raise KeyError(f"User with the same ID is already exists. Existing user: {search[0].name}; New user: {name}")
+        existing = self._users_by_id[is_local].get(user_id)
+        if existing is not None:
+            raise KeyError(f"User with the same ID is already exists. Existing user: {existing.name}; New user: {name}")
 
         if image is not None:
-            if self.recognizer is not None:
+            if self.encoding_service is not None:
+                encoding = await self.encoding_service.encode(image)
+            elif self.recognizer is not None:
                 encoding = await asyncio.get_running_loop().run_in_executor(None, self.recognizer.get_face_encoding, image)
             else:
                 logger.error("Failed to get encoding from image durring adding a new user: recognizer is not specified")
@@ -263,17 +433,56 @@ class UserManager:
         if encoding is None:
             raise ValueError("The image and the encoding cannot be None at the same time")
 
-        user = User(user_id, name, encoding, is_local=is_local)
+        user = User(user_id, name, encoding, is_local=is_local, api_client=self.api_client, opening_queue=self.opening_queue)
+        self.index.add(self.encodings.add(user, user.encoding, user.is_active))
         users.append(user)
+        self._users_by_id[is_local][user_id] = user
         logger.info(f"User {user} was added to the {'local' if is_local else 'remote'} list")
+        self._notify("add", user)
+        return user
 
     def remove_user(self, user_id: int, is_local: bool):
         users = self.local_users if is_local else self.remote_users
-        search = [(i, u) for i, u in enumerate(users) if u.user_id == user_id]
-        if not search:
+        user = self._users_by_id[is_local].pop(user_id, None)
+        if user is None:
             raise ValueError(f"User with ID {user_id} doesn't exist")
-        del users[search[0][0]]
-        logger.info(f"User {search[0][1]} was removed from the {'local' if is_local else 'remote'} list")
+        users.remove(user)
+        self.index.remove(self.encodings.get_slot(user))
+        self.encodings.remove(user)
+        store = self.local_store if is_local else self.remote_store
+        if store is not None and user_id in store:
+            store.delete(user_id)
+        logger.info(f"User {user} was removed from the {'local' if is_local else 'remote'} list")
+        self._notify("remove", user)
+
+    def _notify(self, event: str, user: User):
+        for listener in self.user_listeners:
+            try:
+                listener(event, user)
+            except Exception as ex:
+                logger.error(f"User listener failed on '{event}' of {user}", exc_info=ex)
+
+    def set_user_active(self, user: User, is_active: bool):
+        user.is_active = is_active
+        self.encodings.set_active(user, is_active)
+        self._notify("update", user)
 
     def get_all_active_users(self):
         return [u for u in self.local_users if u.is_active] + [u for u in self.remote_users if u.is_active]
+
+    def match_encoding(self, encoding: Union[numpy.ndarray, list]) -> Union[MatchResult, None]:
+        """
+        Finds the nearest active user to the encoding. `MatchResult.key` is the matched `User`.
+        The distance threshold is not applied here; see `Recognizer.MATCHING_THRESHOLD`.
+        :return: None if there are no active users
+        """
+        return self.index.search(encoding)
+
+    def match_encodings(self, encodings: list) -> list:
+        """
+        Batch version of `match_encoding`.
+        :return: `MatchResult` or None per encoding
+        """
+        if not encodings:
+            return []
+        return self.index.search_many(numpy.stack(encodings))